@@ -0,0 +1,49 @@
+"""
+Scaling of AlmostConstantFeatureRemover with the number of columns, per-column value_counts vs the vectorized method.
+Run from the repository root:
+
+    python -m benchmarks.bench_almost_constant --rows 10000 --cols 100 1000 5000
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from src.removers import AlmostConstantFeatureRemover
+
+
+def make_frame(n_rows, n_cols, constant_share=0.1, seed=0):
+    rng = np.random.RandomState(seed)
+    values = rng.normal(size=(n_rows, n_cols))
+    n_constant = int(n_cols * constant_share)
+    values[:, :n_constant] = np.where(rng.uniform(size=(n_rows, n_constant)) < 0.95, 0.0, values[:, :n_constant])
+    return pd.DataFrame(values, columns=['f{}'.format(i) for i in range(n_cols)])
+
+
+def time_fit(method, df, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        remover = AlmostConstantFeatureRemover(90, verbose=False, method=method)
+        start = time.perf_counter()
+        remover.fit(df, df.columns)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--cols', type=int, nargs='+', default=[100, 500, 1000, 2000, 5000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{:>8} {:>8} {:>14} {:>14} {:>8}'.format('rows', 'cols', 'per_column, s', 'vectorized, s', 'speedup'))
+    for n_cols in args.cols:
+        df = make_frame(args.rows, n_cols)
+        per_column = time_fit('per_column', df, args.repeat)
+        vectorized = time_fit('vectorized', df, args.repeat)
+        print('{:>8} {:>8} {:>14.4f} {:>14.4f} {:>8.1f}'.format(args.rows, n_cols, per_column, vectorized,
+                                                               per_column / vectorized))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Startup cost of a worker: importing the package (in a fresh interpreter) and creating a DataProcessor,
+without and with saved settings. Run from the repository root:
+
+    python -m benchmarks.bench_startup --cols 100 10000 --non-feature 10 1000
+"""
+import argparse
+import contextlib
+import io
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+
+IMPORT_SCRIPT = 'import time; start = time.perf_counter(); import {}; print(time.perf_counter() - start)'
+
+
+def time_import(module, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT.format(module)], capture_output=True,
+                                text=True, check=True).stdout
+        best = min(best, float(output))
+    return best
+
+
+def time_construction(path, df, non_feature_columns, repeat):
+    from src.dataprocessor import DataProcessor
+
+    best = np.inf
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            DataProcessor(path, df, non_feature_columns=non_feature_columns, verbose=False, use_cache=False)
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--cols', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--non-feature', type=int, nargs='+', default=[10, 1000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for module in ['src.transforms', 'src.dataprocessor']:
+        print('import {:<20} {:>8.4f} s'.format(module, time_import(module, args.repeat)))
+
+    from src.dataprocessor import DataProcessor
+
+    print('{:>8} {:>12} {:>14} {:>14}'.format('cols', 'non-feature', 'new, s', 'saved, s'))
+    for n_cols in args.cols:
+        df = pd.DataFrame(np.zeros((1, n_cols)), columns=['f{}'.format(i) for i in range(n_cols)])
+        for n_non_feature in args.non_feature:
+            non_feature_columns = list(df.columns[:min(n_non_feature, n_cols)])
+            with tempfile.TemporaryDirectory() as path:
+                new = time_construction(path, df, non_feature_columns, args.repeat)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    dp = DataProcessor(path, df, non_feature_columns=non_feature_columns, use_cache=False)
+                    dp.features['selected'] = dp.features['all']
+                    dp.save()
+                saved = time_construction(path, df, non_feature_columns, args.repeat)
+            print('{:>8} {:>12} {:>14.6f} {:>14.6f}'.format(n_cols, len(non_feature_columns), new, saved))
+
+
+if __name__ == '__main__':
+    main()
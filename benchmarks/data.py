@@ -0,0 +1,97 @@
+"""
+Synthetic feature frames and HDF5 files for the benchmarks
+"""
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_DTYPES = {'float64': 0.7, 'float32': 0.2, 'int64': 0.1}
+
+
+def parse_dtypes(text):
+    """
+    Parse a dtype mix like 'float64=0.7,float32=0.2,int64=0.1'
+    :param text:
+    :return: dict of dtype name to share of the columns
+    """
+    dtypes = {}
+    for item in text.split(','):
+        name, share = item.split('=')
+        dtypes[name.strip()] = float(share)
+    return dtypes
+
+
+def make_frame(n_rows, n_cols, dtypes=None, group_size=5, noise=0.3, constant_share=0.1, heavy_tailed_share=0.1,
+               nan_share=0.0, seed=0):
+    """
+    Feature frame with a known structure:
+    - the columns come in groups of group_size that share a latent factor, the correlation between two columns
+      of a group is about 1 / (1 + noise^2);
+    - constant_share of the columns are almost constant (95% of the rows hold one value);
+    - heavy_tailed_share of the columns are exponentials of the latent values, so LogTransformer selects them;
+    - nan_share of the values of the float columns are missing.
+    The groups and the special columns are spread randomly over the columns
+    :param n_rows:
+    :param n_cols:
+    :param dtypes: dict of dtype name to share of the columns, DEFAULT_DTYPES if None
+    :param group_size: 1 for independent columns
+    :param noise:
+    :param constant_share:
+    :param heavy_tailed_share:
+    :param nan_share:
+    :param seed:
+    :return: dataframe with columns f0, f1, ...
+    """
+    rng = np.random.RandomState(seed)
+    dtypes = DEFAULT_DTYPES if dtypes is None else dtypes
+
+    n_groups = -(-n_cols // group_size)
+    latent = rng.normal(size=(n_rows, n_groups))
+    values = latent[:, rng.permutation(np.arange(n_cols) // group_size)] + noise * rng.normal(size=(n_rows, n_cols))
+
+    order = rng.permutation(n_cols)
+    n_constant = int(n_cols * constant_share)
+    n_heavy = int(n_cols * heavy_tailed_share)
+    constant, heavy = order[:n_constant], order[n_constant:n_constant + n_heavy]
+    values[:, constant] = np.where(rng.uniform(size=(n_rows, n_constant)) < 0.95, 1.0, values[:, constant])
+    values[:, heavy] = np.exp(4 * values[:, heavy])
+
+    shares = np.array(list(dtypes.values()), dtype=np.float64)
+    counts = np.floor(shares / shares.sum() * n_cols).astype(int)
+    counts[0] += n_cols - counts.sum()
+    column_dtypes = np.repeat(list(dtypes.keys()), counts)[rng.permutation(n_cols)]
+
+    columns = {}
+    for i in range(n_cols):
+        dtype = np.dtype(column_dtypes[i])
+        column = values[:, i]
+        if dtype.kind in 'iu':
+            column = np.round(column * 100)
+        elif nan_share > 0:
+            column = np.where(rng.uniform(size=n_rows) < nan_share, np.nan, column)
+        columns['f{}'.format(i)] = column.astype(dtype)
+    return pd.DataFrame(columns)
+
+
+def write_hdf_keys(df, path, n_keys, merge_on='fname'):
+    """
+    Split the columns of df over n_keys tables of one HDF5 file, every table with the merge_on column
+    and its rows in a different order, as load_and_merge_dataframes expects them
+    :param df:
+    :param path:
+    :param n_keys:
+    :param merge_on:
+    :return: list of keys
+    """
+    rng = np.random.RandomState(0)
+    names = np.array(['row_{}'.format(i) for i in range(len(df))])
+    keys = []
+    with pd.HDFStore(path, mode='w') as store:
+        for i, columns in enumerate(np.array_split(np.asarray(df.columns), n_keys)):
+            part = df[list(columns)].copy()
+            part.insert(0, merge_on, names)
+            part = part.iloc[rng.permutation(len(part))].reset_index(drop=True)
+            key = 'part{}'.format(i)
+            store.put(key, part, format='table', data_columns=[merge_on])
+            keys.append(key)
+    return keys
@@ -0,0 +1,191 @@
+"""
+Time and memory benchmarks of the removers, transforms, DataProcessor and load_and_merge_dataframes on synthetic data.
+Results are written to a JSON file named after the current commit, so that runs on different commits can be compared.
+Run from the repository root:
+
+    python -m benchmarks.run --rows 100000 --cols 500
+    python -m benchmarks.run --cases correlated_blockwise log_transform --rows 10000 --cols 100 1000
+    python -m benchmarks.run --compare benchmarks/results/abc1234.json benchmarks/results/def5678.json
+"""
+import argparse
+import json
+import pathlib
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from src.dataprocessor import DataProcessor
+from src.profiling import peak_rss
+from src.removers import CorrelatedFeatureRemover, AlmostConstantFeatureRemover
+from src.transforms import LogTransformer
+from src.utils import load_and_merge_dataframes
+from .data import DEFAULT_DTYPES, make_frame, parse_dtypes, write_hdf_keys
+
+
+def _correlated(method):
+    def run(df, tmp_dir, args):
+        CorrelatedFeatureRemover(args.threshold, verbose=False, method=method, n_jobs=args.n_jobs).fit(
+            df, list(df.columns))
+    return run
+
+
+def _almost_constant(df, tmp_dir, args):
+    AlmostConstantFeatureRemover(90, verbose=False, n_jobs=args.n_jobs).fit(df, list(df.columns))
+
+
+def _log_transform(df, tmp_dir, args):
+    LogTransformer(copy=True).fit(df).transform(df)
+
+
+def _dataprocessor(df, tmp_dir):
+    dp = DataProcessor(tmp_dir, df, non_feature_columns=[], verbose=False, use_cache=False)
+    dp.add_remover(CorrelatedFeatureRemover, {'correlation_threshold': 0.9, 'verbose': False})
+    dp.add_remover(AlmostConstantFeatureRemover, {'max_count_percent': 90, 'verbose': False})
+    dp.add_transform(LogTransformer, {})
+    return dp
+
+
+def _fit_remove(df, tmp_dir, args):
+    _dataprocessor(df, tmp_dir).fit_remove(df)
+
+
+def _fit_transform(df, tmp_dir, args):
+    dp = _dataprocessor(df, tmp_dir)
+    dp.features['selected'] = dp.features['all']
+    dp.fit_transform(df.copy())
+
+
+def _load_and_merge(streaming):
+    def run(df, tmp_dir, args):
+        load_and_merge_dataframes(tmp_dir + 'data.h5', args.keys, exclude_cols_except_first=[], streaming=streaming)
+    return run
+
+
+CASES = {'correlated_blockwise': _correlated('blockwise'),
+         'correlated_sampled': _correlated('sampled'),
+         'correlated_dense': _correlated('dense'),
+         'almost_constant': _almost_constant,
+         'log_transform': _log_transform,
+         'fit_remove': _fit_remove,
+         'fit_transform': _fit_transform,
+         'load_and_merge': _load_and_merge(False),
+         'load_and_merge_streaming': _load_and_merge(True)}
+DEFAULT_CASES = [case for case in CASES if case != 'correlated_dense']  # dense is quadratic in memory
+
+
+def measure(run, df, tmp_dir, args):
+    """
+    Best wall time over args.repeat runs, then one more run under tracemalloc for the peak of the memory allocated
+    by Python and numpy, and the growth of the peak RSS of the process over all runs
+    :return: dict
+    """
+    start_rss = peak_rss()
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        run(df, tmp_dir, args)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        run(df, tmp_dir, args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    end_rss = peak_rss()
+    return {'best_time': min(times), 'mean_time': float(np.mean(times)), 'peak_alloc': peak,
+            'peak_rss_delta': end_rss - start_rss if end_rss is not None else None}
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                               text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return revision + ('-dirty' if dirty else '')
+
+
+def run_benchmarks(args):
+    results = []
+    for n_rows in args.rows:
+        for n_cols in args.cols:
+            df = make_frame(n_rows, n_cols, args.dtypes, args.group_size, args.noise, args.constant_share,
+                            args.heavy_tailed_share, args.nan_share)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                tmp_dir += '/'
+                if any(case.startswith('load_and_merge') for case in args.cases):
+                    args.keys = write_hdf_keys(df, tmp_dir + 'data.h5', args.n_keys)
+                for case in args.cases:
+                    result = {'case': case, 'rows': n_rows, 'cols': n_cols}
+                    result.update(measure(CASES[case], df, tmp_dir, args))
+                    results.append(result)
+                    print('{case:>26} {rows:>9} {cols:>6} {best_time:>10.4f} {peak_alloc:>14,}'.format(**result))
+    return results
+
+
+def compare(old_path, new_path):
+    with open(old_path, 'r') as f:
+        old = json.load(f)
+    with open(new_path, 'r') as f:
+        new = json.load(f)
+    old_results = {(r['case'], r['rows'], r['cols']): r for r in old['results']}
+
+    print('{} -> {}'.format(old['revision'], new['revision']))
+    print('{:>26} {:>9} {:>6} {:>10} {:>10} {:>8} {:>8}'.format('case', 'rows', 'cols', 'old, s', 'new, s',
+                                                                 'time', 'memory'))
+    for r in new['results']:
+        o = old_results.get((r['case'], r['rows'], r['cols']))
+        if o is None:
+            continue
+        print('{:>26} {:>9} {:>6} {:>10.4f} {:>10.4f} {:>7.2f}x {:>7.2f}x'.format(
+            r['case'], r['rows'], r['cols'], o['best_time'], r['best_time'], r['best_time'] / o['best_time'],
+            r['peak_alloc'] / max(o['peak_alloc'], 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=DEFAULT_CASES)
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000])
+    parser.add_argument('--cols', type=int, nargs='+', default=[200])
+    parser.add_argument('--dtypes', type=parse_dtypes, default=DEFAULT_DTYPES,
+                        help="share of every dtype, e.g. 'float64=0.7,float32=0.2,int64=0.1'")
+    parser.add_argument('--group-size', type=int, default=5, help='columns sharing a latent factor')
+    parser.add_argument('--noise', type=float, default=0.3)
+    parser.add_argument('--constant-share', type=float, default=0.1)
+    parser.add_argument('--heavy-tailed-share', type=float, default=0.1)
+    parser.add_argument('--nan-share', type=float, default=0.0)
+    parser.add_argument('--threshold', type=float, default=0.9, help='correlation threshold')
+    parser.add_argument('--n-keys', type=int, default=3, help='HDF5 tables the columns are split over')
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='benchmarks/results', help='directory for the results')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    print('{:>26} {:>9} {:>6} {:>10} {:>14}'.format('case', 'rows', 'cols', 'best, s', 'peak alloc, B'))
+    results = run_benchmarks(args)
+
+    revision = git_revision()
+    report = {'revision': revision, 'timestamp': time.time(), 'python': platform.python_version(),
+              'numpy': np.__version__, 'pandas': pd.__version__, 'machine': platform.platform(),
+              'config': {key: value for key, value in vars(args).items() if key not in ('compare', 'keys')},
+              'results': results}
+    pathlib.Path(args.output).mkdir(parents=True, exist_ok=True)
+    output = pathlib.Path(args.output) / (revision + '.json')
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Results written to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import hashlib
+import inspect
+import json
+import os
+import pathlib
+import pickle
+import tempfile
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_MAX_SIZE = 1024 ** 3  # bytes
+CACHE_FORMAT_VERSION = 1  # part of every key, bump it when the fitted state of a remover or transform changes
+
+# settings that do not change the fitted result
+_UNKEYED_PARAMS = {'verbose', 'n_jobs', 'backend'}
+
+
+def effective_params(cls, params=None):
+    """
+    Constructor parameters an object of cls is created with from params: the defaults from the signature,
+    overridden by params, so that a change of a default also changes the cache key
+    :param cls: remover or transform class
+    :param params: parameters passed to the constructor
+    :return: dict
+    """
+    parameters = inspect.signature(cls.__init__).parameters.values()
+    effective = {p.name: p.default for p in parameters
+                 if p.name != 'self' and p.kind not in (p.VAR_POSITIONAL, p.VAR_KEYWORD)
+                 and p.default is not p.empty}
+    effective.update(params or {})
+    return {name: value for name, value in effective.items() if name not in _UNKEYED_PARAMS}
+
+
+def _key_value(value):
+    """
+    Parameter value with all of its content, for hashing: mappings and Series (e.g. precomputed scores) become
+    lists of (key, value) sorted by key, arrays become lists; str() would truncate them
+    """
+    if isinstance(value, pd.Series):
+        value = value.to_dict()
+    if isinstance(value, Mapping):
+        return sorted(([str(key), _key_value(item)] for key, item in value.items()), key=lambda pair: pair[0])
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+
+def fingerprint(df, feature_columns, name: str, params=None):
+    """
+    Content-addressed key of a fit: hash of the data in the feature columns, of the feature list
+    and of the parameters of the remover/transform
+    :param df:
+    :param feature_columns:
+    :param name: name of the remover/transform class
+    :param params: constructor parameters of the remover/transform
+    :return: hex digest
+    """
+    feature_columns = list(feature_columns)
+    h = hashlib.blake2b(digest_size=20)
+    h.update(json.dumps([CACHE_FORMAT_VERSION, name, _key_value(params)], default=str).encode())
+    h.update(json.dumps([str(col) for col in feature_columns]).encode())
+    h.update(json.dumps([str(dtype) for dtype in df[feature_columns].dtypes]).encode())
+    h.update(pd.util.hash_pandas_object(df[feature_columns], index=False).values.tobytes())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk cache of fitted removers and transforms, one pickle per key. The modification time of a file
+    is bumped on every hit, and the least recently used files are evicted once the total size exceeds max_size
+    """
+    def __init__(self, path: str, max_size: int=DEFAULT_MAX_SIZE):
+        if not path.endswith('/'):
+            path += '/'
+        self.path = path
+        self.max_size = max_size
+
+    def _file(self, key: str):
+        return pathlib.Path(self.path + key + '.pkl')
+
+    def get(self, key: str):
+        """
+        Load the object stored under key
+        :param key:
+        :return: the stored object, or None if there is no (readable) entry
+        """
+        f = self._file(key)
+        try:
+            with open(f, 'rb') as fh:
+                obj = pickle.load(fh)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            f.unlink(missing_ok=True)
+            return None
+        try:
+            os.utime(f)
+        except FileNotFoundError:
+            pass
+        return obj
+
+    def put(self, key: str, obj):
+        """
+        Store obj under key, then evict least recently used entries above the size limit
+        :param key:
+        :param obj:
+        :return:
+        """
+        pathlib.Path(self.path).mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                pickle.dump(obj, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._file(key))
+        except BaseException:
+            pathlib.Path(tmp).unlink(missing_ok=True)
+            raise
+        self._evict(keep=self._file(key))
+
+    def _evict(self, keep=None):
+        entries = []
+        for f in pathlib.Path(self.path).glob('*.pkl'):
+            try:
+                stat = f.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, f))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, f in sorted(entries, key=lambda entry: entry[0]):
+            if total_size <= self.max_size:
+                break
+            if f == keep:
+                continue
+            f.unlink(missing_ok=True)
+            total_size -= size
@@ -0,0 +1,306 @@
+import numpy as np
+from .parallel import SharedArray
+
+
+DEFAULT_MEMORY_BUDGET = 256 * 1024 ** 2  # bytes of tile workspace
+
+
+def block_size_for_budget(n_cols: int, memory_budget: int=DEFAULT_MEMORY_BUDGET, n_tiles: int=1):
+    """
+    Largest square tile side such that n_tiles float64 tiles fit into memory_budget bytes
+    :param n_cols: number of columns, the tile side is never larger than that
+    :param memory_budget: bytes available for tile workspace
+    :param n_tiles: number of b x b float64 matrices alive at the same time
+    :return:
+    """
+    block_size = int(np.sqrt(memory_budget / (8.0 * n_tiles)))
+    return max(1, min(n_cols, block_size))
+
+
+def correlation_from_sums(n, sx, sy, sxx, syy, sxy):
+    """
+    Pairwise-complete Pearson correlation from sums over the rows where both x and y are observed
+    :param n: number of such rows
+    :param sx: sum of x
+    :param sy: sum of y
+    :param sxx: sum of x ** 2
+    :param syy: sum of y ** 2
+    :param sxy: sum of x * y
+    :return: correlation, 0 where it is undefined
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = sxy - sx * sy / n
+        var_x = sxx - sx * sx / n
+        var_y = syy - sy * sy / n
+        corr = cov / np.sqrt(var_x * var_y)
+    corr[~((n >= 2) & (var_x > 0) & (var_y > 0))] = 0.0
+    return corr
+
+
+class CorrelationStatistics:
+    """
+    Sufficient statistics for the pairwise-complete correlation matrix, merged chunk by chunk: the number of
+    common observations, the sums and the cross-products of every pair of columns. As long as no missing value
+    has been seen, the counts and sums are kept per column and only the cross-products are a full matrix
+    """
+    def __init__(self):
+        self.n_rows = 0
+        self._shift = None
+
+    def update(self, values):
+        """
+        Add a chunk of rows
+        :param values: 2D float array, with the same columns for every chunk
+        :return:
+        """
+        values = np.asarray(values, dtype=np.float64)
+        mask = np.isnan(values)
+        if self._shift is None:
+            # shifting every column by a typical value keeps the sums well-conditioned
+            with np.errstate(invalid='ignore'):
+                counts = (~mask).sum(axis=0)
+                self._shift = np.where(counts > 0, np.nansum(values, axis=0) / np.maximum(counts, 1), 0.0)
+            self.has_nan = False
+            self.sxy = np.zeros((values.shape[1], values.shape[1]))
+            self._count, self._sum, self._sum_squares = 0, np.zeros(values.shape[1]), np.zeros(values.shape[1])
+        elif values.shape[1] != len(self._shift):
+            raise ValueError('Expected {} columns, got {}'.format(len(self._shift), values.shape[1]))
+
+        x = values - self._shift
+        if mask.any() and not self.has_nan:
+            # from now on counts and sums depend on the pair of columns
+            p = len(self._shift)
+            self.n = np.full((p, p), float(self._count))
+            self.sx = np.repeat(self._sum[:, None], p, axis=1)
+            self.sxx = np.repeat(self._sum_squares[:, None], p, axis=1)
+            self.has_nan = True
+
+        if self.has_nan:
+            x[mask] = 0.0
+            observed = (~mask).astype(np.float64)
+            self.n += observed.T @ observed
+            self.sx += x.T @ observed
+            self.sxx += (x * x).T @ observed
+        else:
+            self._count += len(x)
+            self._sum += x.sum(axis=0)
+            self._sum_squares += np.einsum('ij,ij->j', x, x)
+        self.sxy += x.T @ x
+        self.n_rows += len(x)
+
+    def correlation(self, columns=None):
+        """
+        Correlation matrix of the given columns (indices into the columns of the chunks), all of them if None
+        :param columns:
+        :return:
+        """
+        if self._shift is None:
+            raise ValueError('No data has been added')
+        idx = np.arange(len(self._shift)) if columns is None else np.asarray(columns, dtype=np.int64)
+        sxy = self.sxy[np.ix_(idx, idx)]
+        if self.has_nan:
+            n = self.n[np.ix_(idx, idx)]
+            sx = self.sx[np.ix_(idx, idx)]
+            sxx = self.sxx[np.ix_(idx, idx)]
+        else:
+            n = np.full(sxy.shape, float(self._count))
+            sx = np.repeat(self._sum[idx][:, None], len(idx), axis=1)
+            sxx = np.repeat(self._sum_squares[idx][:, None], len(idx), axis=1)
+        return correlation_from_sums(n, sx, sx.T, sxx, sxx.T, sxy)
+
+    def column_moments(self, columns=None):
+        """
+        Number of observations and sample variance of the given columns, all of them if None
+        :param columns:
+        :return: arrays count, variance (NaN for less than two observations)
+        """
+        if self._shift is None:
+            raise ValueError('No data has been added')
+        idx = np.arange(len(self._shift)) if columns is None else np.asarray(columns, dtype=np.int64)
+        if self.has_nan:
+            n, sx, sxx = self.n[idx, idx], self.sx[idx, idx], self.sxx[idx, idx]
+        else:
+            n, sx, sxx = np.full(len(idx), float(self._count)), self._sum[idx], self._sum_squares[idx]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = np.where(n > 1, (sxx - sx * sx / n) / (n - 1), np.nan)
+        return n, np.maximum(variance, 0)
+
+
+class BlockCorrelation:
+    """
+    Pearson correlation of the columns of a 2D array, computed tile by tile with matrix products,
+    so that the full n_cols x n_cols matrix never has to exist in memory.
+
+    Without missing values columns are centred and scaled to unit norm once, and a tile is a single product
+    Z[:, I].T @ Z[:, J]. With missing values pairwise-complete sums are accumulated with the missing-value mask,
+    which reproduces pandas.DataFrame.corr(); constant columns (and pairs with less than two common observations)
+    get a correlation of 0 instead of NaN, which never exceeds a threshold either way.
+
+    memory_budget only bounds the tiles. The standardized data (one n_rows x n_cols float64 array, three with
+    missing values: the data, the mask and the squares) is held for the lifetime of the engine on top of it
+    """
+    _arrays = ('_data', '_observed', '_squares')
+
+    def __init__(self, values, block_size=None, memory_budget: int=DEFAULT_MEMORY_BUDGET, copy=True):
+        """
+
+        :param values: 2D array
+        :param block_size: tile side, derived from memory_budget if None
+        :param memory_budget: bytes of tile workspace
+        :param copy: if False, a float64 Fortran-ordered values is standardized in place (and must not be used
+        by the caller afterwards); other arrays are converted once either way
+        """
+        self._shared = {}
+        self.memory_budget = memory_budget
+        data = np.array(values, dtype=np.float64, order='F', copy=copy or None)
+        del values
+        self.n_rows, self.n_cols = data.shape
+
+        mask = np.isnan(data)
+        self.has_nan = bool(mask.any())
+
+        if self.has_nan:
+            # shifting by the mean does not change the correlation, but keeps the sums below well-conditioned
+            observed = np.asfortranarray(~mask, dtype=np.float64)
+            counts = observed.sum(axis=0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                means = np.where(counts > 0, np.nansum(data, axis=0) / counts, 0.0)
+            data -= means
+            data[mask] = 0.0
+            del mask
+            self._data = data
+            self._observed = observed
+            squares = np.empty_like(data)
+            np.multiply(data, data, out=squares)
+            self._squares = squares
+            n_tiles = 8
+        else:
+            del mask
+            data -= data.mean(axis=0)
+            norms = np.sqrt(np.einsum('ij,ij->j', data, data))
+            nonzero = norms > 0
+            data *= np.where(nonzero, 1 / np.where(nonzero, norms, 1), 0.0)  # constant columns become 0
+            self._data = data
+            n_tiles = 2
+
+        if block_size is None:
+            block_size = block_size_for_budget(self.n_cols, memory_budget, n_tiles)
+        self.block_size = max(1, min(int(block_size), max(self.n_cols, 1)))
+
+    def share(self):
+        """
+        Move the standardized data to shared memory, so that pickling the engine for worker processes
+        passes the names of the memory blocks instead of the data
+        :return: SharedArray handles, to be closed by the caller once the workers are done
+        """
+        for name in self._arrays:
+            if hasattr(self, name) and name not in self._shared:
+                self._shared[name] = SharedArray(getattr(self, name))
+                setattr(self, name, self._shared[name].array)
+        return list(self._shared.values())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self._shared:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name, shared in self._shared.items():
+            setattr(self, name, shared.array)
+
+    def blocks(self):
+        """
+        Column slices of size block_size covering all columns
+        :return:
+        """
+        return [slice(start, min(start + self.block_size, self.n_cols))
+                for start in range(0, self.n_cols, self.block_size)]
+
+    def tile(self, rows, cols):
+        """
+        Correlation matrix between the columns in rows and the columns in cols (slices or index arrays)
+        :param rows:
+        :param cols:
+        :return:
+        """
+        if not self.has_nan:
+            return self._data[:, rows].T @ self._data[:, cols]
+
+        x, y = self._data[:, rows], self._data[:, cols]
+        mx, my = self._observed[:, rows], self._observed[:, cols]
+        return correlation_from_sums(mx.T @ my, x.T @ my, mx.T @ y, self._squares[:, rows].T @ my,
+                                     mx.T @ self._squares[:, cols], x.T @ y)
+
+    def pairs(self, threshold: float, skip=None, row_blocks=None):
+        """
+        Iterate over the upper triangle tile by tile and yield the pairs (i, j), i < j, with |corr| > threshold
+        :param threshold:
+        :param skip: optional boolean array over columns; a tile is not computed if all of its columns j are
+        marked. It is read lazily, so the caller may update it while iterating
+        :param row_blocks: indices into blocks() of the rows of tiles to compute, all of them if None
+        :return: generator of (i, j, corr) arrays with global column indices
+        """
+        blocks = self.blocks()
+        if row_blocks is None:
+            row_blocks = range(len(blocks))
+        for bi in row_blocks:
+            rows = blocks[bi]
+            for cols in blocks[bi:]:
+                if skip is not None and skip[cols].all():
+                    continue
+                corr = self.tile(rows, cols)
+                if rows == cols:
+                    corr = np.triu(corr, k=1)
+                i, j = np.nonzero(np.abs(corr) > threshold)
+                if len(i):
+                    yield i + rows.start, j + cols.start, corr[i, j]
+
+    def pair_correlations(self, i, j):
+        """
+        Correlations of the pairs of columns (i[k], j[k]), in batches of pairs whose gathered columns
+        fit into the memory budget
+        :param i: column indices
+        :param j: column indices
+        :return:
+        """
+        i = np.asarray(i, dtype=np.int64)
+        j = np.asarray(j, dtype=np.int64)
+        corr = np.empty(len(i))
+        n_arrays = 6 if self.has_nan else 2
+        batch = int(max(1, min(len(i), self.memory_budget // (8 * max(self.n_rows, 1) * n_arrays))))
+        for start in range(0, len(i), batch):
+            # with a batch of one pair slicing gives views of the columns instead of copies
+            bi = i[start:start + batch] if batch > 1 else slice(i[start], i[start] + 1)
+            bj = j[start:start + batch] if batch > 1 else slice(j[start], j[start] + 1)
+            x, y = self._data[:, bi], self._data[:, bj]
+            if not self.has_nan:
+                corr[start:start + batch] = np.einsum('ij,ij->j', x, y)
+                continue
+            mx, my = self._observed[:, bi], self._observed[:, bj]
+            sx, sy = np.einsum('ij,ij->j', x, my), np.einsum('ij,ij->j', mx, y)
+            corr[start:start + batch] = correlation_from_sums(
+                np.einsum('ij,ij->j', mx, my), sx, sy, np.einsum('ij,ij->j', self._squares[:, bi], my),
+                np.einsum('ij,ij->j', mx, self._squares[:, bj]), np.einsum('ij,ij->j', x, y))
+        return corr
+
+    def pairs_between(self, threshold: float, rows, cols):
+        """
+        Pairs (i, j), i in rows, j in cols, i != j, with |corr| > threshold; only these tiles are computed
+        :param threshold:
+        :param rows: column indices
+        :param cols: column indices
+        :return: generator of (i, j, corr) arrays with global column indices
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        for a in range(0, len(rows), self.block_size):
+            tile_rows = rows[a:a + self.block_size]
+            for b in range(0, len(cols), self.block_size):
+                tile_cols = cols[b:b + self.block_size]
+                corr = self.tile(tile_rows, tile_cols)
+                i, j = np.nonzero(np.abs(corr) > threshold)
+                keep = tile_rows[i] != tile_cols[j]
+                if keep.any():
+                    yield tile_rows[i][keep], tile_cols[j][keep], corr[i, j][keep]
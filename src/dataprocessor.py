@@ -1,23 +1,56 @@
 import pathlib
-from datetime import datetime
 import json
+import pandas as pd
+from .cache import ResultCache, fingerprint, effective_params, DEFAULT_MAX_SIZE
+from .exceptions import DataProcessorError
+from .featurestore import write_feature_store, open_feature_store
+from .profiling import Profiler
+from .runstore import RunStore, atomic_open, new_run_id
+from .sparse import has_sparse_columns
+from .transforms import TransformChain
+from .validation import make_folds, cross_validate, fit_predict
 
 
 class DataProcessor:
-    def __init__(self, path: str, df, non_feature_columns=None, fname_prefix='', verbose=True):
+    def __init__(self, path: str, df, non_feature_columns=None, fname_prefix='', verbose=True, use_cache=True,
+                 cache_max_size=DEFAULT_MAX_SIZE, n_jobs=1, backend='thread', profile=False, profile_hook=None,
+                 restore=False):
+        """
+
+        :param path:
+        :param df: dataframe with the features; may be None with restore=True, all features then come from
+        the saved run
+        :param non_feature_columns:
+        :param fname_prefix:
+        :param verbose:
+        :param use_cache: if True, fitted removers and transforms are stored in dataprocessor_files/cache,
+        keyed by the data, the feature list and the parameters, and re-used instead of being fitted again
+        :param cache_max_size: size limit of the cache in bytes, least recently used entries are evicted above it
+        :param n_jobs: number of workers for removers that split their work over columns, used unless the
+        remover parameters set it
+        :param backend: 'thread' or 'process' pool for these workers
+        :param profile: if True, the wall time, peak memory growth and data size of every remover fit, transform fit
+        and transform, and save are appended as JSON lines to dataprocessor_files/output/profile.jsonl
+        :param profile_hook: callable receiving every profiling record as a dict, also without profile
+        :param restore: if True, the fitted removers and transforms of the saved run are restored together with
+        their parameters, so that transform can be used without fitting again
+        """
         if not path.endswith('/'):
             path += '/'
         self.base_path = path
         self.removers = []
         self.fname_prefix = fname_prefix
-        self.fname = self.fname_prefix + str(datetime.now()).replace(':', '_').replace(' ', '_')[5:19]
+        self.fname = new_run_id(self.fname_prefix)
         self.remover_params = []
+        self.remover_states = []  # features each remover got and removed in the last fit
+        self.previous_remover_states = []
         self.transforms = []
         self.transform_params = []
 
         self.saved = False
 
-        self.features = {'all': [col for col in df.columns if col not in non_feature_columns],
+        excluded = set(non_feature_columns) if non_feature_columns is not None else set()
+        self.features = {'all': [col for col in df.columns if col not in excluded] if df is not None else [],
                          'selected': [],
                          'removed': []
                         }
@@ -25,30 +58,56 @@ class DataProcessor:
         self.non_feature_columns = non_feature_columns  # stuff like label, filename, etc.
 
         self.verbose = verbose
+        self.n_jobs = n_jobs
+        self.backend = backend
+
+        self.cache = ResultCache(path + 'dataprocessor_files/cache', cache_max_size) if use_cache else None
+        self.profiler = Profiler(path + 'dataprocessor_files/output/profile.jsonl' if profile else None, profile_hook)
 
-        if pathlib.Path(path + 'dataprocessor_files/settings/current_settings.log').exists():
+        self.run_store = RunStore(path)
+        try:
             with open(self.base_path + 'dataprocessor_files/settings/current_settings.log', 'r') as f:
                 self.settings = json.load(f)
+        except FileNotFoundError:
+            self.settings = None
+        if self.settings is not None:
             print('Previous settings file found')
-            with open(path + self.settings['features removed list'], 'r') as f:
-                self.features['removed'] = [l.replace('\n', '') for l in f if l != '\n']
+            if 'run' in self.settings:
+                self._load_run(restore)
+            else:
+                self._load_text_lists(restore)
             print('List of removed features contains {} elements'.format(len(self.features['removed'])))
-            with open(path + self.settings['features selected list'], 'r') as f:
-                self.features['selected'] = [l.replace('\n', '') for l in f if l != '\n']
             print('List of selected features contains {} elements'.format(len(self.features['selected'])))
         else:
             print('No previous settings file found')
             self.settings = {}
+            if restore:
+                raise DataProcessorError('No saved run to restore')
+        # the directories in dataprocessor_files are created when something is first written to them
 
-        # store lists of features to be removed
-        pathlib.Path(path + 'dataprocessor_files/features/removed').mkdir(parents=True, exist_ok=True)
-        pathlib.Path(path + 'dataprocessor_files/features/selected').mkdir(parents=True, exist_ok=True)
+    def _load_run(self, restore):
+        lists = self.run_store.read_feature_lists(self.settings['run'])
+        self.features['removed'] = lists['removed']
+        self.features['selected'] = lists['selected']
+        if not self.features['all'] and 'all' in lists:
+            self.features['all'] = lists['all']
+        self.previous_remover_states = [{'input': lists['remover {} input'.format(i)],
+                                         'removed': lists['remover {} removed'.format(i)]}
+                                        for i in range(len(self.settings['removers']))
+                                        if 'remover {} input'.format(i) in lists]
+        if restore:
+            state = self.run_store.read_state(self.settings['run'])
+            self.removers, self.remover_params = state['removers'], state['remover_params']
+            self.transforms, self.transform_params = state['transforms'], state['transform_params']
 
-        # store logs for cv and predictions
-        pathlib.Path(path + 'dataprocessor_files/output/cv').mkdir(parents=True, exist_ok=True)
-        pathlib.Path(path + 'dataprocessor_files/output/predictions').mkdir(parents=True, exist_ok=True)
-
-        pathlib.Path(path + 'dataprocessor_files/settings').mkdir(parents=True, exist_ok=True)
+    def _load_text_lists(self, restore):
+        # settings saved before the run store existed
+        if restore:
+            raise DataProcessorError('The saved settings have no fitted state to restore')
+        with open(self.base_path + self.settings['features removed list'], 'r') as f:
+            self.features['removed'] = [l.replace('\n', '') for l in f if l != '\n']
+        with open(self.base_path + self.settings['features selected list'], 'r') as f:
+            self.features['selected'] = [l.replace('\n', '') for l in f if l != '\n']
 
     def return_features_list(self, use_features: str='selected'):
         """
@@ -60,15 +119,81 @@ class DataProcessor:
         return self.features[use_features]
 
     def add_remover(self, remover, remover_params):
-        self.removers.append(remover(**remover_params))
+        remover = remover(**remover_params)
+        # the parallel settings do not change the result, so they are not part of the remover parameters
+        if hasattr(remover, 'n_jobs') and 'n_jobs' not in remover_params:
+            remover.n_jobs = self.n_jobs
+        if hasattr(remover, 'backend') and 'backend' not in remover_params:
+            remover.backend = self.backend
+        self.removers.append(remover)
         self.remover_params.append(remover_params)
         return self
 
-    def fit_remove(self, df):
+    def _cache_key(self, obj, params, df, feature_columns):
+        """
+        Cache key for fitting obj on df[feature_columns], or None if the result should not be cached
+        :param obj: remover or transform
+        :param params: parameters obj was constructed with
+        :param df:
+        :param feature_columns:
+        :return:
+        """
+        if self.cache is None or not getattr(obj, 'persistent', True):
+            return None
+        return fingerprint(df, feature_columns, type(obj).__name__, effective_params(type(obj), params))
+
+    def _load_cached(self, obj, key):
+        if key is None or getattr(obj, 'force_recompute', False):
+            return None
+        fitted = self.cache.get(key)
+        if fitted is not None and self.verbose:
+            print('Loaded fitted {} from cache'.format(fitted))
+        return fitted
+
+    def _previous_state(self, i):
+        """
+        Saved input and output of remover i, if the previous settings had the same remover at that position
+        """
+        if i >= len(self.previous_remover_states) or len(self.settings.get('removers', [])) <= i:
+            return None
+        if (self.settings['removers'][i] != str(self.removers[i])
+                or self.settings['remover_params'][i] != str(self.remover_params[i])):
+            return None
+        return self.previous_remover_states[i]
+
+    def fit_remove(self, df, incremental=False):
+        """
+        Fit the removers one after another, each on the features left by the previous ones
+        :param df:
+        :param incremental: if True, removers that were saved with the same parameters only re-check
+        what changed since the saved fit (new features, and features whose decision depended on removed ones);
+        the data of the features present in both fits is assumed to be unchanged
+        :return:
+        """
         current_features_to_use = self.return_features_list('all')
         features_removed = []
-        for remover in self.removers:
-            current_features_to_use, to_be_removed = remover.fit(df, current_features_to_use)
+        self.remover_states = []
+        for i, (remover, remover_params) in enumerate(zip(self.removers, self.remover_params)):
+            self.remover_states.append({'input': list(current_features_to_use)})
+            previous = self._previous_state(i) if incremental else None
+            with self.profiler.stage('fit', str(remover), len(df), len(current_features_to_use)) as record:
+                if previous is not None and hasattr(remover, 'fit_incremental'):
+                    record['incremental'] = True
+                    current_features_to_use, to_be_removed = remover.fit_incremental(
+                        df, current_features_to_use, previous['input'], previous['removed'])
+                else:
+                    key = self._cache_key(remover, remover_params, df, current_features_to_use)
+                    fitted = self._load_cached(remover, key)
+                    record['cached'] = fitted is not None
+                    if fitted is not None:
+                        self.removers[i] = fitted
+                        current_features_to_use, to_be_removed = fitted.columns_to_leave, fitted.columns_to_remove
+                    else:
+                        current_features_to_use, to_be_removed = remover.fit(df, current_features_to_use)
+                        if key is not None:
+                            self.cache.put(key, remover)
+                record['removed'] = len(to_be_removed)
+            self.remover_states[i]['removed'] = list(to_be_removed)
             features_removed += to_be_removed
         features_removed = list(set(features_removed))
         self.features['removed'] = features_removed
@@ -82,16 +207,33 @@ class DataProcessor:
 
     def fit_transform(self, df, use_features: str='selected'):
         """
-        Fit and apply transforms to a dataframe
+        Fit and apply transforms to a dataframe. The features are copied into one float array,
+        transformed in place by the whole chain and written back to the dataframe once; if some of them are
+        pandas sparse columns, the transforms are applied to the columns one after another instead, so that they
+        are not densified
         :param df:
-        :param transform:
         :param use_features:
         :return:
         """
         features_to_use = self.return_features_list(use_features)
+        if not self.transforms:
+            return
+
+        def fit_step(i, transform, X):
+            key = self._cache_key(transform, self.transform_params[i], X, features_to_use)
+            fitted = self._load_cached(transform, key)
+            if fitted is not None:
+                return fitted
+            transform.fit(X)
+            if key is not None:
+                self.cache.put(key, transform)
+            return transform
 
-        for transform, transform_params in zip(self.transforms, self.transform_params):
-            df[features_to_use] = transform.fit_transform(df[features_to_use])
+        if has_sparse_columns(df, features_to_use):
+            df[features_to_use] = self._transform_sparse(df[features_to_use], fit_step)
+            return
+        chain = TransformChain(self.transforms, verbose=self.verbose, profiler=self.profiler)
+        df[features_to_use] = chain.fit_transform(chain.extract(df, features_to_use), features_to_use, fit_step)
 
     def transform(self, df, use_features: str='selected'):
         """
@@ -101,66 +243,243 @@ class DataProcessor:
         :return:
         """
         features_to_use = self.return_features_list(use_features)
+        if not self.transforms:
+            return
+
+        if has_sparse_columns(df, features_to_use):
+            df[features_to_use] = self._transform_sparse(df[features_to_use])
+            return
+        chain = TransformChain(self.transforms, verbose=self.verbose, profiler=self.profiler)
+        df[features_to_use] = chain.transform(chain.extract(df, features_to_use))
+
+    def _transform_sparse(self, X, fit_step=None):
+        """
+        Apply (and fit, with fit_step as in TransformChain.fit_transform) the transforms to a frame
+        with sparse columns, each on the output of the previous one
+        """
+        for i, transform in enumerate(self.transforms):
+            if fit_step is not None:
+                with self.profiler.stage('fit', str(transform), *X.shape):
+                    self.transforms[i] = transform = fit_step(i, transform, X)
+            with self.profiler.stage('transform', str(transform), *X.shape):
+                X = transform.transform(X)
+        return X
+
+    def fit_stream(self, chunks, use_features: str='selected'):
+        """
+        Fit removers and transforms on data that does not fit into memory. The removers merge bounded
+        statistics (candidate value counts, sums, cross-products) over one pass through the chunks; removers with
+        partial_verify check their candidates in a second pass, and then all of them decide together.
+        Every transform is fitted with partial_fit in a further pass, on chunks transformed by the previous ones
+        :param chunks: callable that returns a new iterator over dataframe chunks every time it is called,
+        e.g. lambda: pd.read_csv(path, chunksize=100000)
+        :param use_features: features the transforms are fitted on
+        :return:
+        """
+        for obj in self.removers + self.transforms:
+            if not hasattr(obj, 'partial_fit'):
+                raise DataProcessorError('{} cannot be fitted in chunks'.format(obj))
+
+        if self.removers:
+            all_features = self.return_features_list('all')
+            for chunk in chunks():
+                for remover in self.removers:
+                    remover.partial_fit(chunk, all_features)
+            verifying = [remover for remover in self.removers if hasattr(remover, 'partial_verify')]
+            if verifying:
+                for chunk in chunks():
+                    for remover in verifying:
+                        remover.partial_verify(chunk)
+
+            current_features_to_use = all_features
+            features_removed = []
+            for remover in self.removers:
+                current_features_to_use, to_be_removed = remover.finalize(current_features_to_use)
+                features_removed += to_be_removed
+            self.features['removed'] = list(set(features_removed))
+            self.features['selected'] = current_features_to_use
+
+        features_to_use = self.return_features_list(use_features)
+        for i, transform_params in enumerate(self.transform_params):
+            transform = type(self.transforms[i])(**transform_params)
+            for chunk in chunks():
+                X = chunk[features_to_use]
+                for fitted in self.transforms[:i]:
+                    X = fitted.transform(X)
+                transform.partial_fit(X)
+            self.transforms[i] = transform
+        return self
 
-        for transform, transform_params in zip(self.transforms, self.transform_params):
-            df[features_to_use] = transform.transform(df[features_to_use], **transform_params)
+    def transform_stream(self, chunks, use_features: str='selected'):
+        """
+        Apply the fitted transforms chunk by chunk
+        :param chunks: iterable of dataframe chunks
+        :param use_features:
+        :return: generator of transformed chunks
+        """
+        for chunk in chunks:
+            self.transform(chunk, use_features)
+            yield chunk
 
-    def cv(self, df, predictor, scorers, predict_proba=False, df_test=None, use_features: str='selected'):
+    def cv(self, df, predictor, scorers, predict_proba=False, df_test=None, use_features: str='selected',
+           target=None, n_splits: int=5, shuffle=True, random_state=None, stratify=False, n_jobs=None,
+           backend=None):
+        """
+        Cross-validate the whole pipeline: in every fold the removers, transforms and the predictor
+        are fitted on the training rows only, and all scorers are evaluated on one set of predictions
+        of the validation rows. The folds run concurrently with n_jobs > 1
+        :param df:
+        :param predictor: unfitted estimator with fit and predict (or predict_proba)
+        :param scorers: list of (scorer(y_true, y_pred), scorer name)
+        :param predict_proba:
+        :param df_test: if given, the pipeline is fitted on all of df, and the predictions for df_test are written
+        to dataprocessor_files/output/predictions
+        :param use_features: 'selected' refits the removers in every fold, starting from all features,
+        other lists are used as they are
+        :param target: name of the target column
+        :param n_splits:
+        :param shuffle:
+        :param random_state:
+        :param stratify:
+        :param n_jobs: number of folds running at the same time, the n_jobs of the DataProcessor if None
+        :param backend: 'thread' or 'process', the backend of the DataProcessor if None; processes memory-map
+        the data from a file in dataprocessor_files/output/cv
+        :return: mean and standard deviation over the folds of every scorer
+        """
+        if target is None or target not in df.columns:
+            raise DataProcessorError('A target column is needed for cross-validation')
+        n_jobs = self.n_jobs if n_jobs is None else n_jobs
+        backend = self.backend if backend is None else backend
 
-        mean_score = [0.0] * len(scorers)
-        std_score = [0.0] * len(scorers)
         if not self.saved:
             print('Dataprocessor settings not saved, will save now')
             self.save()
 
-        with open(self.base_path + 'dataprocessor_files/cv/cv.log', 'a') as f:
+        use_removers = use_features == 'selected' and len(self.removers) > 0
+        # the target is never a feature, also when it is not one of the non-feature columns
+        columns = [col for col in self.return_features_list('all' if use_removers else use_features) if col != target]
+        spec = {'removers': [(type(remover), params) for remover, params in zip(self.removers, self.remover_params)],
+                'transforms': [(type(transform), params)
+                               for transform, params in zip(self.transforms, self.transform_params)],
+                'predictor': predictor, 'predict_proba': predict_proba, 'scorers': scorers,
+                'use_removers': use_removers}
+
+        y = df[target].to_numpy()
+        folds = make_folds(y, n_splits, shuffle, random_state, stratify)
+        pathlib.Path(self.base_path + 'dataprocessor_files/output/cv').mkdir(parents=True, exist_ok=True)
+        scores = cross_validate(TransformChain.extract(df, columns), columns, y, folds, spec, n_jobs, backend,
+                                self.base_path + 'dataprocessor_files/output/cv/data_' + self.fname + '.npy')
+        mean_score = scores.mean(axis=0).tolist()
+        std_score = scores.std(axis=0).tolist()
 
-            for (scorer, scorer_name) in scorers:
-                f.write('Mean(score): {}\nStd(score): {}\n'.format(mean_score, std_score))
-                f.write('Scorer={}, mean(score): {}\nScorer={}, std(score): {}\n'.format(scorer_name, mean_score,
-                                                                                         scorer_name, std_score))
+        with open(self.base_path + 'dataprocessor_files/output/cv/cv.log', 'a') as f:
+
+            for (scorer, scorer_name), mean, std in zip(scorers, mean_score, std_score):
+                f.write('Scorer={}, mean(score): {}\nScorer={}, std(score): {}\n'.format(scorer_name, mean,
+                                                                                         scorer_name, std))
+            f.write('Folds: {}\n'.format(len(folds)))
             f.write('Predictor: {}\nPredict_proba: {}\n'.format(str(predictor), str(predict_proba)))
             f.write('Features used: {}\n'.format(use_features))
             f.write('Selected features list: {}\n'.format(self.base_path + 'dataprocessor_files/features/selected/'
                                                           + self.fname))
             f.write('Removed features list: {}\n'.format(self.base_path + 'dataprocessor_files/features/removed/'
                                                          + self.fname))
+            f.write('Removers: {}\n'.format([str(remover) for remover in self.removers]))
+            f.write('Transforms: {}\n'.format([str(transform) for transform in self.transforms]))
+
+            if df_test is not None:
+                predictions, _ = fit_predict(df, y, df_test, columns, spec['removers'], spec['transforms'],
+                                             predictor, predict_proba, use_removers)
+                predictions_file = self.base_path + 'dataprocessor_files/output/predictions/' + self.fname + '.csv'
+                pathlib.Path(predictions_file).parent.mkdir(parents=True, exist_ok=True)
+                pd.DataFrame(predictions, index=df_test.index).to_csv(predictions_file)
+                f.write('Test predictions: {}\n'.format(predictions_file))
 
             f.write('\n\n\n')
-        # Write mean, std (score); names of feature lists, list of feature removers and transforms and their settings
-        # also can run on df_test and predict there
-        pass
+
+        return mean_score, std_score
 
     def save(self):
-        self.fname = self.fname_prefix + str(datetime.now()).replace(':', '_').replace(' ', '_')[5:19]
-        with open(self.base_path + 'dataprocessor_files/features/removed/' + self.fname, 'w') as f:
-            for feature in self.features['removed']:
-                f.write('{}\n'.format(feature))
+        with self.profiler.stage('save', 'DataProcessor', columns=len(self.features['all'])):
+            self._save()
 
-        with open(self.base_path + 'dataprocessor_files/features/selected/' + self.fname, 'w') as f:
-            for feature in self.features['selected']:
-                f.write('{}\n'.format(feature))
+    def _save(self):
+        """
+        Write a new run to the run store (feature lists as indexes into the column dictionary, the fitted
+        removers and transforms), the feature lists as text for reading, and then replace the current settings.
+        Every file is written atomically under a unique name, so concurrent jobs do not overwrite each other
+        """
+        previous_settings = self.settings
+        self.fname = new_run_id(self.fname_prefix)
+
+        for name in ['removed', 'selected']:
+            with atomic_open(self.base_path + 'dataprocessor_files/features/{}/'.format(name) + self.fname) as f:
+                f.write(''.join('{}\n'.format(feature) for feature in self.features[name]))
+
+        feature_lists = {'all': self.features['all'], 'removed': self.features['removed'],
+                         'selected': self.features['selected']}
+        for i, state in enumerate(self.remover_states):
+            feature_lists['remover {} input'.format(i)] = state['input']
+            feature_lists['remover {} removed'.format(i)] = state['removed']
+        state = {'removers': self.removers, 'remover_params': self.remover_params,
+                 'transforms': self.transforms, 'transform_params': self.transform_params}
+        run_path = self.run_store.write_run(self.fname, self.features['all'], feature_lists, state=state)
+        if self.remover_states:
+            self.previous_remover_states = self.remover_states
 
         self.settings = {'features removed list': 'dataprocessor_files/features/removed/' + self.fname,
                          'features selected list': 'dataprocessor_files/features/selected/' + self.fname,
                          'removers': [str(remover) for remover in self.removers],
                          'remover_params': [str(remover_params) for remover_params in self.remover_params],
-                         'fname': self.fname}
+                         'fname': self.fname,
+                         'run': run_path}
+        for key in ['features data', 'features data format']:
+            if key in previous_settings:
+                self.settings[key] = previous_settings[key]
 
         # move old settings
         if pathlib.Path(self.base_path + 'dataprocessor_files/settings/current_settings.log').exists():
             with open(self.base_path + 'dataprocessor_files/settings/current_settings.log', 'r') as f:
                 old_settings = json.load(f)
 
-            with open(self.base_path
-                      + 'dataprocessor_files/settings/old_settings_{}.log'.format(old_settings['fname']), 'w') as f:
+            with atomic_open(self.base_path
+                             + 'dataprocessor_files/settings/old_settings_{}.log'.format(old_settings['fname'])) as f:
                 json.dump(old_settings, f)
 
-        with open(self.base_path + 'dataprocessor_files/settings/current_settings.log', 'w') as f:
-            json.dump(self.settings, f)
+        self._write_settings()
         self.saved = True
 
-    def write_features(self, df, df_format):
-        # write selected and transformed features to a dataframe
-        # and add that to settings
-        pass
+    def _write_settings(self):
+        with atomic_open(self.base_path + 'dataprocessor_files/settings/current_settings.log') as f:
+            json.dump(self.settings, f)
+
+    def write_features(self, df, df_format: str='npy', use_features: str='selected'):
+        """
+        Write the (transformed) features and the non-feature columns of a dataframe to a columnar store
+        in dataprocessor_files/features/data, and record its location in the settings
+        :param df:
+        :param df_format: 'npy' (one memory-mappable file per column), 'feather' or 'parquet'
+        :param use_features:
+        :return: path of the store
+        """
+        columns = self.return_features_list(use_features)
+        if self.non_feature_columns is not None:
+            columns = columns + [col for col in self.non_feature_columns if col in df.columns]
+
+        relative_path = 'dataprocessor_files/features/data/' + self.fname + '/'
+        write_feature_store(df, self.base_path + relative_path, columns, df_format)
+
+        self.settings['features data'] = relative_path
+        self.settings['features data format'] = df_format
+        if self.saved:
+            self._write_settings()
+        return self.base_path + relative_path
+
+    def open_features(self):
+        """
+        Open the feature store written by write_features, columns are memory-mapped on access
+        :return: FeatureStore
+        """
+        if 'features data' not in self.settings:
+            raise DataProcessorError('No features have been written')
+        return open_feature_store(self.base_path + self.settings['features data'])
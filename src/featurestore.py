@@ -0,0 +1,147 @@
+import json
+import pathlib
+import numpy as np
+import pandas as pd
+from .exceptions import DataProcessorError
+
+
+FORMATS = ('npy', 'feather', 'parquet')
+MANIFEST = 'manifest.json'
+
+
+def _column_array(series):
+    if pd.api.types.is_bool_dtype(series.dtype) and not series.hasnans:
+        return series.to_numpy(dtype=bool)
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        if isinstance(series.dtype, np.dtype):
+            return series.to_numpy()
+        return series.to_numpy(dtype=np.float64, na_value=np.nan)  # nullable extension dtypes
+    if pd.api.types.is_datetime64_dtype(series.dtype):
+        return series.to_numpy()
+    return series.astype(str).to_numpy(dtype=str)  # fixed-width unicode, can be memory-mapped unlike objects
+
+
+def write_feature_store(df, path: str, columns=None, df_format: str='npy'):
+    """
+    Write columns of a dataframe to a directory that can be opened with open_feature_store:
+    'npy' writes one .npy file per column, 'feather' an uncompressed Arrow file (both can be memory-mapped),
+    'parquet' a Parquet file (columns can be read selectively, but are decoded on reading).
+    The index of the dataframe is not stored
+    :param df:
+    :param path: directory to write to
+    :param columns: columns to write, all of them if None
+    :param df_format:
+    :return: path
+    """
+    if df_format not in FORMATS:
+        raise DataProcessorError("Unknown feature store format '{}'".format(df_format))
+    if not path.endswith('/'):
+        path += '/'
+    columns = list(df.columns) if columns is None else list(columns)
+    pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+
+    manifest = {'format': df_format, 'n_rows': len(df), 'columns': [str(col) for col in columns]}
+    if df_format == 'npy':
+        manifest['files'] = []
+        for i, col in enumerate(columns):
+            fname = 'col_{:06d}.npy'.format(i)
+            np.save(path + fname, _column_array(df[col]))
+            manifest['files'].append(fname)
+    else:
+        import pyarrow as pa
+        from pyarrow import feather, parquet
+
+        table = pa.Table.from_pandas(df[columns], preserve_index=False)
+        if df_format == 'feather':
+            feather.write_feather(table, path + 'features.feather', compression='uncompressed')
+        else:
+            parquet.write_table(table, path + 'features.parquet')
+
+    with open(path + MANIFEST, 'w') as f:
+        json.dump(manifest, f)
+    return path
+
+
+def open_feature_store(path: str):
+    """
+    Open a directory written by write_feature_store
+    :param path:
+    :return: FeatureStore
+    """
+    return FeatureStore(path)
+
+
+class FeatureStore:
+    """
+    Read-only access to a feature matrix written by write_feature_store. Opening only reads the manifest;
+    for the 'npy' and 'feather' formats columns are memory-mapped, so only the pages that are used are read
+    """
+    def __init__(self, path: str):
+        if not path.endswith('/'):
+            path += '/'
+        self.path = path
+        try:
+            with open(path + MANIFEST, 'r') as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            raise DataProcessorError("No feature store found at '{}'".format(path))
+        self.format = self.manifest['format']
+        self.columns = self.manifest['columns']
+        self.n_rows = self.manifest['n_rows']
+        self._positions = {col: i for i, col in enumerate(self.columns)}
+
+    def __len__(self):
+        return self.n_rows
+
+    def __contains__(self, column):
+        return column in self._positions
+
+    def _check_columns(self, columns):
+        columns = self.columns if columns is None else list(columns)
+        for col in columns:
+            if col not in self._positions:
+                raise DataProcessorError("Column '{}' not found in feature store".format(col))
+        return columns
+
+    def __getitem__(self, column):
+        """
+        Values of a single column, a read-only memory map for the 'npy' format
+        :param column:
+        :return:
+        """
+        self._check_columns([column])
+        if self.format == 'npy':
+            return np.load(self.path + self.manifest['files'][self._positions[column]], mmap_mode='r')
+        return self._read_table([column]).column(0).to_numpy()
+
+    def _read_table(self, columns):
+        if self.format == 'feather':
+            from pyarrow import feather
+            return feather.read_table(self.path + 'features.feather', columns=columns, memory_map=True)
+        from pyarrow import parquet
+        return parquet.read_table(self.path + 'features.parquet', columns=columns, memory_map=True)
+
+    def to_frame(self, columns=None):
+        """
+        Dataframe with the given columns (all if None); for the 'npy' format every column is a memory map
+        and nothing is copied
+        :param columns:
+        :return:
+        """
+        columns = self._check_columns(columns)
+        if self.format == 'npy':
+            return pd.DataFrame({col: self[col] for col in columns}, copy=False)
+        return self._read_table(columns).to_pandas(split_blocks=True)
+
+    def to_numpy(self, columns=None, dtype=np.float64):
+        """
+        2D array with the given columns (all if None), this is a copy
+        :param columns:
+        :param dtype:
+        :return:
+        """
+        columns = self._check_columns(columns)
+        values = np.empty((self.n_rows, len(columns)), dtype=dtype)
+        for i, col in enumerate(columns):
+            values[:, i] = self[col]
+        return values
@@ -0,0 +1,96 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from .exceptions import DataProcessorError
+
+
+def effective_n_jobs(n_jobs):
+    """
+    Number of workers for n_jobs: None is 1, negative values count back from the number of CPUs (-1 is all of them)
+    :param n_jobs:
+    :return:
+    """
+    if n_jobs is None or n_jobs == 0:
+        return 1
+    if n_jobs < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return n_jobs
+
+
+def get_executor(n_jobs, backend: str='thread'):
+    """
+    Pool executor with effective_n_jobs(n_jobs) workers
+    :param n_jobs:
+    :param backend: 'thread' (numpy sorting and BLAS release the GIL) or 'process'
+    :return:
+    """
+    if backend == 'thread':
+        return ThreadPoolExecutor(max_workers=effective_n_jobs(n_jobs))
+    elif backend == 'process':
+        return ProcessPoolExecutor(max_workers=effective_n_jobs(n_jobs))
+    raise DataProcessorError("Unknown parallel backend '{}'".format(backend))
+
+
+class SharedArray:
+    """
+    A numpy array in shared memory. Pickling it only passes the name of the memory block, so process workers
+    attach to the data of the parent instead of receiving a copy. The creating process owns the block
+    and has to close() it
+    """
+    def __init__(self, array):
+        array = np.asarray(array)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self._owner = True
+        self.shape, self.dtype = array.shape, array.dtype
+        self.fortran = bool(array.flags.f_contiguous and not array.flags.c_contiguous)
+        self.array = self._view()
+        self.array[...] = array
+
+    @classmethod
+    def empty(cls, shape, dtype=np.float64, fortran: bool=False):
+        """
+        Uninitialized shared array, to be filled in place (e.g. column by column) without a full source copy
+        :param shape:
+        :param dtype:
+        :param fortran: column-major layout
+        :return:
+        """
+        shared = cls.__new__(cls)
+        shared.shape, shared.dtype, shared.fortran = tuple(shape), np.dtype(dtype), fortran
+        shared._shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * shared.dtype.itemsize, 1))
+        shared._owner = True
+        shared.array = shared._view()
+        return shared
+
+    def _view(self):
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf, order='F' if self.fortran else 'C')
+
+    def __getstate__(self):
+        return {'name': self._shm.name, 'shape': self.shape, 'dtype': self.dtype.str, 'fortran': self.fortran}
+
+    def __setstate__(self, state):
+        if sys.version_info >= (3, 13):
+            self._shm = shared_memory.SharedMemory(name=state['name'], track=False)
+        else:
+            # pool workers share the resource tracker of the parent, so registering the block again is harmless
+            self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._owner = False
+        self.shape, self.dtype, self.fortran = tuple(state['shape']), np.dtype(state['dtype']), state['fortran']
+        self.array = self._view()
+
+    def close(self):
+        self.array = None
+        try:
+            self._shm.close()
+        except BufferError:
+            pass  # views of the array are still alive, the mapping goes away with them
+        if self._owner:
+            self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,76 @@
+import json
+import pathlib
+import sys
+import time
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss():
+    """
+    Peak resident set size of the process in bytes, None where it cannot be measured
+    :return:
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # kilobytes on Linux
+
+
+class Profiler:
+    """
+    Records the wall time, the growth of the peak RSS and the number of rows and columns of pipeline stages.
+    Every record is appended as a JSON line to path (if set) and passed to hook (if set);
+    without either of them the profiler does nothing
+    """
+    def __init__(self, path=None, hook=None):
+        """
+
+        :param path: JSON-lines file to append records to
+        :param hook: callable receiving every record as a dict
+        """
+        self.path = path
+        self.hook = hook
+        self.enabled = path is not None or hook is not None
+        self._created = False
+
+    @contextmanager
+    def stage(self, name: str, component=None, rows=None, columns=None, **extra):
+        """
+        Time the enclosed block
+        :param name: stage, e.g. 'fit' or 'transform'
+        :param component: what runs in the stage, e.g. str(remover)
+        :param rows: number of rows processed
+        :param columns: number of columns processed
+        :param extra: other fields of the record
+        :return: the record, which the block may update before it is written
+        """
+        record = {'stage': name, 'component': component, 'rows': rows, 'columns': columns}
+        record.update(extra)
+        if not self.enabled:
+            yield record
+            return
+
+        start_rss = peak_rss()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['wall_time'] = time.perf_counter() - start
+            end_rss = peak_rss()
+            record['peak_rss_delta'] = end_rss - start_rss if end_rss is not None else None
+            record['timestamp'] = time.time()
+            self._emit(record)
+
+    def _emit(self, record):
+        if self.path is not None:
+            if not self._created:
+                pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+                self._created = True
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+        if self.hook is not None:
+            self.hook(record)
@@ -1,6 +1,13 @@
+import copy
+from statistics import NormalDist
 import pandas as pd
 import numpy as np
 from .exceptions import DataProcessorError
+from .correlation import BlockCorrelation, CorrelationStatistics, DEFAULT_MEMORY_BUDGET
+from .parallel import SharedArray, effective_n_jobs, get_executor
+from .transforms import TransformChain
+from .sparse import (has_sparse_columns, issparse, to_csc, to_frame, correlated_pairs, sparse_column_modal_count,
+                     modal_counts as sparse_modal_counts)
 
 
 class BaseFeatureRemover:
@@ -8,12 +15,210 @@ class BaseFeatureRemover:
 
 
 class PredictorBasedFeatureRemover:
-    pass
+    def __init__(self, predictor, target, step=0.1, min_features=1, scorer=None, n_splits=3, stratify=False,
+                 patience=2, tol=0.0, warm_start=True, n_candidates=1, n_jobs=1, backend='process', random_state=None,
+                 verbose=True, force_recompute=False):
+        """
+        Recursive elimination: fit the predictor in every cross-validation fold, score it, and remove the
+        features with the lowest importance (feature_importances_, or the absolute coef_ summed over outputs, so
+        the features should be on comparable scales for linear models), round after round. The features of the
+        smallest subset with a mean score within tol of the best one are kept
+        :param predictor: unfitted estimator, it is cloned
+        :param target: name of the target column of the dataframe
+        :param step: fraction of the remaining features removed per round (at least one), or a number of features
+        if it is an integer >= 1
+        :param min_features: elimination stops at this number of features
+        :param scorer: scorer(y_true, y_pred), higher is better; the score method of the predictor if None
+        :param n_splits: number of cross-validation folds
+        :param stratify: keep the class proportions in every fold
+        :param patience: elimination stops after this many rounds that do not improve the best score by more than tol
+        :param tol: score difference treated as a plateau
+        :param warm_start: if the predictor has a warm_start parameter and a coef_, the fit of every fold starts
+        from the coefficients of the previous round, restricted to the remaining features
+        :param n_candidates: number of nested subsets evaluated per round: the next n_candidates elimination steps
+        are all taken from the importances of the last subset of the previous round, and all folds of all of them
+        are fitted at the same time. With 1 the importances are recomputed after every step
+        :param n_jobs: number of fits run at the same time, at most n_splits * n_candidates, so with
+        n_candidates=1 only the folds of one subset run in parallel
+        :param backend: 'thread' or 'process'; with processes the data is put into shared memory
+        :param random_state: seed for the folds
+        :param verbose:
+        :param force_recompute:
+        """
+        self.predictor = predictor
+        self.target = target
+        self.step = step
+        self.min_features = min_features
+        self.scorer = scorer
+        self.n_splits = n_splits
+        self.stratify = stratify
+        self.patience = patience
+        self.tol = tol
+        self.warm_start = warm_start
+        self.n_candidates = n_candidates
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.random_state = random_state
+        self.verbose = verbose
+        self.force_recompute = force_recompute
+        self.persistent = False  # the result depends on the target, which is not part of the cache key
+        self.columns_to_remove = []
+        self.columns_to_leave = []
+        self.fitted = False
+
+    def __str__(self):
+        return 'PredictorBasedFeatureRemover(predictor={}, step={})'.format(self.predictor, self.step)
+
+    def _n_to_remove(self, n_features):
+        if self.step >= 1:
+            n = int(self.step)
+        else:
+            n = max(1, int(n_features * self.step))
+        return min(n, n_features - self.min_features)
+
+    def fit(self, df, feature_columns, y=None):
+        """
+        :param df:
+        :param feature_columns:
+        :param y: target values, e.g. of the training rows of a cross-validation fold; df[target] if None
+        :return:
+        """
+        from .validation import make_folds
+
+        feature_columns = list(feature_columns)
+        if y is None and self.target not in df.columns:
+            raise DataProcessorError("Target column '{}' not found".format(self.target))
+        if len(feature_columns) <= self.min_features:
+            self.history_ = []
+            self.columns_to_remove = []
+            return self._set_result(feature_columns)
+
+        values = df[feature_columns].to_numpy(dtype=np.float64)
+        y = df[self.target].to_numpy() if y is None else np.asarray(y)
+        folds = make_folds(y, self.n_splits, shuffle=True, random_state=self.random_state, stratify=self.stratify)
+
+        candidates = [np.arange(len(feature_columns))]
+        estimators = [None] * len(folds)
+        previous = None
+        best_score, rounds_without_improvement = -np.inf, 0
+        subsets = []
+        self.history_ = []
+
+        n_jobs = min(effective_n_jobs(self.n_jobs), len(folds) * max(1, self.n_candidates))
+        shared = SharedArray(values) if n_jobs > 1 and self.backend == 'process' else None
+        executor = get_executor(n_jobs, self.backend) if n_jobs > 1 else None
+        try:
+            while candidates:
+                # the folds of all candidate subsets of the round are fitted together
+                args = [(self.predictor, estimators[k] if self.warm_start else None,
+                         None if previous is None else np.searchsorted(previous, subset),
+                         shared if shared is not None else values, y, train_idx, valid_idx, subset, self.scorer)
+                        for subset in candidates for k, (train_idx, valid_idx) in enumerate(folds)]
+                if executor is None:
+                    results = [_fit_fold(*a) for a in args]
+                else:
+                    results = [future.result() for future in [executor.submit(_fit_fold, *a) for a in args]]
+
+                stop = False
+                for c, subset in enumerate(candidates):
+                    subset_results = results[c * len(folds):(c + 1) * len(folds)]
+                    score = float(np.mean([score for _, score, _ in subset_results]))
+                    self.history_.append({'n_features': len(subset), 'score': score})
+                    if self.verbose:
+                        print('{} features, score {:.6g}'.format(len(subset), score))
+
+                    subsets.append(subset)
+                    if score > best_score + self.tol:
+                        rounds_without_improvement = 0
+                    else:
+                        rounds_without_improvement += 1
+                    best_score = max(best_score, score)
+                    if rounds_without_improvement >= self.patience:
+                        stop = True
+                        break
+                if stop:
+                    break
+
+                estimators = [estimator for estimator, _, _ in subset_results]
+                importances = np.mean([importance for _, _, importance in subset_results], axis=0)
+                # stable sort, so that ties are broken by the column order
+                order = np.argsort(importances, kind='stable')
+                previous, n_left, candidates = subset, len(subset), []
+                for _ in range(max(1, self.n_candidates)):
+                    n_to_remove = self._n_to_remove(n_left)
+                    if n_to_remove <= 0:
+                        break
+                    n_left -= n_to_remove
+                    candidates.append(np.delete(previous, order[:len(previous) - n_left]))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if shared is not None:
+                shared.close()
+
+        # the smallest subset that scores within tol of the best one
+        self.best_score_ = best_score
+        best = min((len(subset), i) for i, (subset, h) in enumerate(zip(subsets, self.history_))
+                   if h['score'] >= best_score - self.tol)[1]
+        kept = set(subsets[best].tolist())
+        self.columns_to_remove = [col for i, col in enumerate(feature_columns) if i not in kept]
+        return self._set_result(feature_columns)
+
+    def _set_result(self, feature_columns):
+        removed = set(self.columns_to_remove)
+        self.columns_to_leave = [col for col in feature_columns if col not in removed]
+        self.fitted = True
+
+        if self.verbose:
+            print(str(len(self.columns_to_remove)) + ' features found with a low importance for ' + str(self.predictor))
+
+        return self.columns_to_leave, self.columns_to_remove
+
+
+def _importances(estimator):
+    if hasattr(estimator, 'feature_importances_'):
+        return np.asarray(estimator.feature_importances_, dtype=np.float64)
+    if hasattr(estimator, 'coef_'):
+        coef = np.abs(np.asarray(estimator.coef_, dtype=np.float64))
+        return coef.reshape(-1, coef.shape[-1]).sum(axis=0)
+    raise DataProcessorError('{} has neither feature_importances_ nor coef_'.format(estimator))
+
+
+def _fit_fold(predictor, previous, keep, values, y, train_idx, valid_idx, columns, scorer):
+    """
+    Fit a predictor on the training rows and the given columns, and score it on the validation rows
+    :param predictor: unfitted estimator
+    :param previous: estimator fitted on this fold in the previous round, for a warm start, or None
+    :param keep: positions of columns among the columns of the previous round
+    :return: fitted estimator, score, importances
+    """
+    from sklearn.base import clone
+
+    if isinstance(values, SharedArray):
+        values = values.array
+    if (previous is not None and hasattr(previous, 'coef_')
+            and previous.get_params().get('warm_start') is not None):
+        # copied, the candidate subsets of a round all start from the same estimator
+        estimator = copy.deepcopy(previous)
+        estimator.set_params(warm_start=True)
+        estimator.coef_ = np.ascontiguousarray(np.asarray(previous.coef_)[..., keep])
+    else:
+        estimator = clone(predictor)
+
+    estimator.fit(values[np.ix_(train_idx, columns)], y[train_idx])
+    X_valid, y_valid = values[np.ix_(valid_idx, columns)], y[valid_idx]
+    if scorer is None:
+        score = estimator.score(X_valid, y_valid)
+    else:
+        score = scorer(y_valid, estimator.predict(X_valid))
+    return estimator, score, _importances(estimator)
 
 
 class CorrelatedFeatureRemover:
     def __init__(self, correlation_threshold=0.9, verbose=True, force_recompute=False, write_to_file=False,
-                 load_from_file=False):
+                 load_from_file=False, method='blockwise', block_size=None, memory_budget=DEFAULT_MEMORY_BUDGET,
+                 n_jobs=1, backend='thread', sample_size=100000, false_negative_rate=0.01, random_state=None,
+                 strategy='order', representative_score='variance'):
         """
 
         :param correlation_threshold:
@@ -21,21 +226,320 @@ class CorrelatedFeatureRemover:
         :param force_recompute:
         :param write_to_file: if is a string (filename), write correlation matrix to file
         :param load_from_file: if is a string (filename), load correlation matrix from file
+        :param method: 'blockwise' computes the correlation matrix tile by tile without storing it,
+        'dense' builds the full matrix with pandas, 'sampled' screens all pairs on a sample of rows and computes
+        exact correlations only for the candidates; writing to or loading from a file always uses the full matrix
+        :param block_size: number of columns per tile for the blockwise method, derived from memory_budget if None
+        :param memory_budget: bytes of tile workspace for the blockwise method, shared between the workers
+        :param n_jobs: number of workers computing rows of tiles in parallel for the blockwise method
+        :param backend: 'thread' or 'process'; with processes the standardized data is put into shared memory
+        :param sample_size: number of rows used for screening by the sampled method
+        :param false_negative_rate: probability that the sampled method misses a pair with a correlation just
+        above the threshold; the screening threshold is lowered by the corresponding Fisher z confidence bound
+        :param random_state: seed for the row sample
+        :param strategy: 'order' removes every column that is correlated with a column before it; 'cluster' groups
+        the columns into the connected components of the graph of correlated pairs and keeps the column with the
+        highest representative_score of every component (ties are broken by the column name), so the result
+        does not depend on the column order
+        :param representative_score: for the cluster strategy, 'variance', 'missing_rate' (the lowest one is kept),
+        a mapping of column name to score (e.g. precomputed importances, missing columns score lowest) or
+        a callable(df, columns) returning one score per column; only the columns in clusters are scored
+
+        Dataframes with pandas sparse columns and scipy.sparse matrices (with column indices as feature_columns)
+        are handled by all methods except 'dense' and the correlation files from their stored values only,
+        unless they have missing values
         """
+        if method not in ('blockwise', 'dense', 'sampled'):
+            raise DataProcessorError("Unknown correlation method '{}'".format(method))
+        if strategy not in ('order', 'cluster'):
+            raise DataProcessorError("Unknown strategy '{}'".format(strategy))
+        if isinstance(representative_score, str) and representative_score not in ('variance', 'missing_rate'):
+            raise DataProcessorError("Unknown representative score '{}'".format(representative_score))
         self.correlation_threshold = correlation_threshold
         self.columns_to_remove = []
         self.columns_to_leave = []
         self.fitted = False
         self.verbose = verbose
         self.force_recompute = force_recompute
-        self.persistent = True
+        # the result depends only on the data and the parameters unless a correlation file is involved;
+        # a callable score cannot be part of the cache key (and a lambda cannot be pickled)
+        self.persistent = not (write_to_file or load_from_file or callable(representative_score))
         self.write_to_file = write_to_file
         self.load_from_file = load_from_file
+        self.method = method
+        self.block_size = block_size
+        self.memory_budget = memory_budget
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.sample_size = sample_size
+        self.false_negative_rate = false_negative_rate
+        self.random_state = random_state
+        self.strategy = strategy
+        self.representative_score = representative_score
 
     def __str__(self):
         return 'CorrelatedFeatureRemover(correlation_threshold={})'.format(self.correlation_threshold)
 
     def fit(self, df, feature_columns):
+        feature_columns = list(feature_columns)
+        if self._uses_sparse(df, feature_columns):
+            values = to_csc(df, feature_columns)
+            if values is not None:
+                i, j = correlated_pairs(values, self.correlation_threshold)
+                return self._remove_from_pairs(df, feature_columns, i, j)
+            if self.verbose:
+                print('Sparse features have missing values, their correlations are computed on dense data')
+        if issparse(df):
+            df = to_frame(df, feature_columns)
+
+        if self.strategy == 'cluster':
+            i, j = self._correlated_pairs(df, feature_columns)
+            return self._remove_from_pairs(df, feature_columns, i, j)
+        if self.load_from_file or self.write_to_file or self.method == 'dense':
+            self.columns_to_remove = self._find_correlated_dense(df, feature_columns)
+        elif self.method == 'sampled' and len(df) > self.sample_size:
+            self.columns_to_remove = self._find_correlated_sampled(df, feature_columns)
+        else:
+            self.columns_to_remove = self._find_correlated_blockwise(df, feature_columns)
+        return self._set_result(feature_columns)
+
+    def _correlated_pairs(self, df, feature_columns):
+        """
+        All pairs (i, j), i < j, of positions in feature_columns with |corr| > correlation_threshold
+        """
+        if self.load_from_file or self.write_to_file or self.method == 'dense':
+            corr = self._dense_correlation(df, feature_columns).to_numpy()
+            return np.nonzero(np.triu(corr > self.correlation_threshold, k=1))
+        if self.method == 'sampled' and len(df) > self.sample_size:
+            return self._sampled_pairs(df, feature_columns)
+        pairs = self._map_row_blocks(df, feature_columns, _pairs_in_row_blocks)
+        return np.concatenate([i for i, _ in pairs]), np.concatenate([j for _, j in pairs])
+
+    def _remove_from_pairs(self, df, feature_columns, i, j):
+        marked = np.zeros(len(feature_columns), dtype=bool)
+        if self.strategy == 'order':
+            marked[j] = True
+        elif len(i):
+            clustered = np.unique(np.concatenate([i, j]))
+            scores = np.full(len(feature_columns), -np.inf)
+            scores[clustered] = self._representative_scores(df, [feature_columns[k] for k in clustered])
+            marked = cluster_representatives(len(feature_columns), i, j, scores, feature_columns)
+        self.columns_to_remove = [col for col, m in zip(feature_columns, marked) if m]
+        return self._set_result(feature_columns)
+
+    def _representative_scores(self, df, columns):
+        """
+        Scores of the given columns for choosing the representative of a cluster, higher is better
+        """
+        score = self.representative_score
+        name = score if isinstance(score, str) else None
+        if issparse(df):
+            from scipy import sparse
+            df = sparse.csc_matrix(df)
+        if callable(score):
+            scores = score(df, columns)
+        elif name == 'variance' and issparse(df):
+            values = df[:, columns]
+            scores = np.asarray(values.multiply(values).mean(axis=0)).ravel() - np.square(
+                np.asarray(values.mean(axis=0)).ravel())
+        elif name == 'variance':
+            scores = [df[col].var() for col in columns]
+        elif name == 'missing_rate' and issparse(df):
+            values = df[:, columns]
+            entry_columns = np.repeat(np.arange(len(columns)), np.diff(values.indptr))
+            scores = -np.bincount(entry_columns[np.isnan(values.data)], minlength=len(columns)) / df.shape[0]
+        elif name == 'missing_rate':
+            scores = [-df[col].isna().mean() for col in columns]
+        else:
+            scores = [score.get(col, np.nan) for col in columns]
+        scores = np.broadcast_to(np.asarray(scores, dtype=np.float64), (len(columns),))
+        return np.where(np.isnan(scores), -np.inf, scores)
+
+    def _uses_sparse(self, df, feature_columns):
+        return (not (self.load_from_file or self.write_to_file) and self.method != 'dense'
+                and has_sparse_columns(df, feature_columns))
+
+    def _set_result(self, feature_columns):
+        columns_to_remove = set(self.columns_to_remove)
+        self.columns_to_leave = [x for x in feature_columns if x not in columns_to_remove]
+        self.fitted = True
+
+        if self.verbose:
+            print(str(len(self.columns_to_remove))
+                  + ' features found with a correlation higher than ' + str(self.correlation_threshold))
+
+        return self.columns_to_leave, self.columns_to_remove
+
+    def fit_incremental(self, df, feature_columns, previous_columns, previous_removed):
+        """
+        Update the decisions of a previous fit after features were added or removed, assuming that the data
+        of the features present in both is unchanged. Only the correlations of new features with all features,
+        and of previously removed features that lost a preceding feature, are computed
+        :param df:
+        :param feature_columns:
+        :param previous_columns: feature_columns of the previous fit
+        :param previous_removed: columns removed by the previous fit
+        :return:
+        """
+        feature_columns = list(feature_columns)
+        previous_position = {col: i for i, col in enumerate(previous_columns)}
+        old = np.array([col in previous_position for col in feature_columns], dtype=bool)
+        old_positions = [previous_position[col] for col, o in zip(feature_columns, old) if o]
+        if (self.method != 'blockwise' or self.strategy != 'order' or self.load_from_file or self.write_to_file
+                or has_sparse_columns(df, feature_columns) or any(np.diff(old_positions) < 0)):
+            return self.fit(df, feature_columns)  # the order of the previous features changed
+
+        previous_removed = set(previous_removed)
+        was_removed = np.array([col in previous_removed for col in feature_columns], dtype=bool)
+        # a column keeps its previous decision unless a new column now precedes it (which can only remove it),
+        # or, for a removed column, one of its previous predecessors is gone (which can only keep it)
+        new_before = np.cumsum(~old) - ~old
+        old_before = np.cumsum(old) - old
+        lost_predecessor = np.zeros(len(feature_columns), dtype=bool)
+        lost_predecessor[old] = np.asarray(old_positions) > old_before[old]
+
+        check_all = np.flatnonzero(~old | (was_removed & lost_predecessor))
+        check_new = np.flatnonzero(old & ~was_removed & (new_before > 0))
+
+        marked = old & was_removed & ~lost_predecessor
+        if len(check_all) or len(check_new):
+            engine = BlockCorrelation(TransformChain.extract(df, feature_columns), block_size=self.block_size,
+                                      memory_budget=self.memory_budget, copy=False)
+            searches = [(np.arange(len(feature_columns)), check_all), (np.flatnonzero(~old), check_new)]
+            for rows, cols in searches:
+                if len(rows) and len(cols):
+                    for i, j, _ in engine.pairs_between(self.correlation_threshold, rows, cols):
+                        marked[j[i < j]] = True
+
+        self.columns_to_remove = [col for col, m in zip(feature_columns, marked) if m]
+        return self._set_result(feature_columns)
+
+    def partial_fit(self, df, feature_columns):
+        """
+        Merge the correlation statistics (counts, sums and cross-products) of a chunk of rows,
+        the decision is made by finalize
+        :param df:
+        :param feature_columns: the same for every chunk
+        :return:
+        """
+        if self.load_from_file or self.write_to_file:
+            raise DataProcessorError('CorrelatedFeatureRemover with a correlation file cannot be fitted in chunks')
+        if not hasattr(self, '_statistics'):
+            self._statistics = CorrelationStatistics()
+            self._stream_columns = list(feature_columns)
+        self._statistics.update(df[self._stream_columns].to_numpy(dtype=np.float64))
+        return self
+
+    def finalize(self, feature_columns=None):
+        """
+        Find the correlated features from the statistics merged by partial_fit
+        :param feature_columns: subset of the columns passed to partial_fit, all of them if None
+        :return:
+        """
+        positions = _stream_positions(self, feature_columns)
+        feature_columns = [self._stream_columns[i] for i in positions]
+        corr = np.abs(self._statistics.correlation(positions))
+        if self.strategy == 'cluster':
+            i, j = np.nonzero(np.triu(corr > self.correlation_threshold, k=1))
+            scores = self._stream_scores(positions, feature_columns)
+            marked = cluster_representatives(len(feature_columns), i, j, scores, feature_columns)
+        else:
+            marked = (np.triu(corr, k=1) > self.correlation_threshold).any(axis=0)
+        self.columns_to_remove = [col for col, m in zip(feature_columns, marked) if m]
+        del self._statistics, self._stream_columns
+        return self._set_result(feature_columns)
+
+    def _stream_scores(self, positions, feature_columns):
+        score = self.representative_score
+        if callable(score):
+            raise DataProcessorError('A callable representative score needs the data, it cannot be used with '
+                                     'partial_fit; pass precomputed scores as a mapping instead')
+        if isinstance(score, str) and score == 'variance':
+            scores = self._statistics.column_moments(positions)[1]
+        elif isinstance(score, str) and score == 'missing_rate':
+            scores = self._statistics.column_moments(positions)[0] / max(self._statistics.n_rows, 1) - 1
+        else:
+            scores = np.array([score.get(col, np.nan) for col in feature_columns], dtype=np.float64)
+        return np.where(np.isnan(scores), -np.inf, scores)
+
+    def _find_correlated_blockwise(self, df, feature_columns):
+        feature_columns = list(feature_columns)
+        marked = np.logical_or.reduce(self._map_row_blocks(df, feature_columns, _correlated_in_row_blocks))
+        return [col for col, m in zip(feature_columns, marked) if m]
+
+    def _map_row_blocks(self, df, feature_columns, worker):
+        """
+        Run worker(engine, row_blocks, threshold) over the rows of tiles of the correlation matrix of
+        df[feature_columns], on n_jobs workers
+        :return: list of the results
+        """
+        n_jobs = effective_n_jobs(self.n_jobs)
+        # the columns are gathered into one array, which the engine standardizes in place
+        engine = BlockCorrelation(TransformChain.extract(df, feature_columns), block_size=self.block_size,
+                                  memory_budget=self.memory_budget / n_jobs, copy=False)
+        n_blocks = len(engine.blocks())
+
+        if n_jobs == 1 or n_blocks == 1:
+            return [worker(engine, range(n_blocks), self.correlation_threshold)]
+        shared = engine.share() if self.backend == 'process' else []
+        try:
+            with get_executor(n_jobs, self.backend) as executor:
+                futures = [executor.submit(worker, engine, [bi], self.correlation_threshold)
+                           for bi in range(n_blocks)]
+                return [future.result() for future in futures]
+        finally:
+            del engine
+            for shared_array in shared:
+                shared_array.close()
+
+    def _find_correlated_sampled(self, df, feature_columns):
+        feature_columns = list(feature_columns)
+        marked = np.zeros(len(feature_columns), dtype=bool)
+        marked[self._sampled_pairs(df, feature_columns)[1]] = True
+        return [col for col, m in zip(feature_columns, marked) if m]
+
+    def _sampled_pairs(self, df, feature_columns):
+        # screening: for a pair with correlation r above the threshold, atanh of the sample correlation is
+        # approximately normal around atanh(r) with variance 1 / (sample_size - 3)
+        rng = np.random.default_rng(self.random_state)
+        sample = np.sort(rng.choice(len(df), self.sample_size, replace=False))
+        z = NormalDist().inv_cdf(1 - self.false_negative_rate)
+        threshold = min(self.correlation_threshold, 1 - 1e-12)
+        screening_threshold = max(0.0, np.tanh(np.arctanh(threshold) - z / np.sqrt(self.sample_size - 3)))
+
+        engine = BlockCorrelation(TransformChain.extract(df.iloc[sample], feature_columns), block_size=self.block_size,
+                                  memory_budget=self.memory_budget, copy=False)
+        candidates = [(i, j) for i, j, _ in engine.pairs(screening_threshold)]
+        del engine
+        candidates_i = np.concatenate([i for i, _ in candidates]) if candidates else np.zeros(0, dtype=np.int64)
+        candidates_j = np.concatenate([j for _, j in candidates]) if candidates else np.zeros(0, dtype=np.int64)
+
+        n_pairs = len(feature_columns) * (len(feature_columns) - 1) // 2
+        self.n_candidate_pairs_ = len(candidates_i)
+        self.n_pairs_pruned_ = n_pairs - self.n_candidate_pairs_
+        if self.verbose:
+            print('{} of {} pairs pruned by screening on {} rows'.format(self.n_pairs_pruned_, n_pairs,
+                                                                        self.sample_size))
+
+        # verification on all rows, for the candidates only: only the columns in candidate pairs are converted
+        if not len(candidates_i):
+            return candidates_i, candidates_j
+        used = np.unique(np.concatenate([candidates_i, candidates_j]))
+        engine = BlockCorrelation(TransformChain.extract(df, [feature_columns[k] for k in used]),
+                                  block_size=self.block_size, memory_budget=self.memory_budget, copy=False)
+        corr = engine.pair_correlations(np.searchsorted(used, candidates_i), np.searchsorted(used, candidates_j))
+        found = np.abs(corr) > self.correlation_threshold
+        return candidates_i[found], candidates_j[found]
+
+    def _find_correlated_dense(self, df, feature_columns):
+        corr = self._dense_correlation(df, feature_columns)
+        upper = corr.where(np.triu(np.ones(corr.shape), k=1).astype(bool))
+        return [col for col in upper.columns if any(upper[col] > self.correlation_threshold)]
+
+    def _dense_correlation(self, df, feature_columns):
+        """
+        Absolute correlation matrix of feature_columns, from the correlation file if load_from_file is set
+        """
         if self.load_from_file:
             corr = pd.read_csv(self.load_from_file, index_col=0)
             corr = corr.abs()
@@ -43,32 +547,129 @@ class CorrelatedFeatureRemover:
             for col in feature_columns:
                 if col not in corr.columns:
                     raise DataProcessorError("Column '{}' not found in correlation file".format(col))
+            if self.strategy == 'cluster':
+                corr = corr.loc[feature_columns, feature_columns]
         else:
             corr = df[feature_columns].corr()
             if self.write_to_file:
                 corr.to_csv(self.write_to_file)
             corr = corr.abs()
+        return corr
 
-        upper = corr.where(np.triu(np.ones(corr.shape), k=1).astype(np.bool))
-        self.columns_to_remove = [col for col in upper.columns if any(upper[col] > self.correlation_threshold)]
-        self.columns_to_leave = [x for x in feature_columns if x not in self.columns_to_remove]
-        self.fitted = True
 
-        if self.verbose:
-            print(str(len(self.columns_to_remove))
-                  + ' features found with a correlation higher than ' + str(self.correlation_threshold))
+def _stream_positions(remover, feature_columns):
+    if not hasattr(remover, '_stream_columns'):
+        raise DataProcessorError('{} has not been given any chunks with partial_fit'.format(remover))
+    positions = {col: i for i, col in enumerate(remover._stream_columns)}
+    if feature_columns is None:
+        return list(range(len(positions)))
+    for col in feature_columns:
+        if col not in positions:
+            raise DataProcessorError("Column '{}' was not passed to partial_fit".format(col))
+    return [positions[col] for col in feature_columns]
 
-        return self.columns_to_leave, self.columns_to_remove
+
+def _correlated_in_row_blocks(engine, row_blocks, threshold):
+    """
+    Mark the columns j that have a pair (i, j), i < j, with |corr| > threshold, for i in the given rows of tiles
+    :param engine: BlockCorrelation
+    :param row_blocks:
+    :param threshold:
+    :return: boolean array over columns
+    """
+    # a column is removed if any column before it is correlated with it, so once a column is marked
+    # there is no need to compute tiles in which all columns are already marked
+    marked = np.zeros(engine.n_cols, dtype=bool)
+    for _, j, _ in engine.pairs(threshold, skip=marked, row_blocks=row_blocks):
+        marked[j] = True
+    return marked
+
+
+def _pairs_in_row_blocks(engine, row_blocks, threshold):
+    """
+    Pairs (i, j), i < j, with |corr| > threshold, for i in the given rows of tiles
+    :param engine: BlockCorrelation
+    :param row_blocks:
+    :param threshold:
+    :return: arrays i, j
+    """
+    pairs = [(i, j) for i, j, _ in engine.pairs(threshold, row_blocks=row_blocks)]
+    if not pairs:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate([i for i, _ in pairs]), np.concatenate([j for _, j in pairs])
+
+
+def cluster_representatives(n_cols, i, j, scores, names):
+    """
+    Group the columns into the connected components of the graph with the edges (i, j), and mark every column
+    of a component except the one with the highest score for removal; ties are broken by the smallest name,
+    so the result does not depend on the order of the columns
+    :param n_cols:
+    :param i: column indices
+    :param j: column indices
+    :param scores: one per column
+    :param names: column names
+    :return: boolean array over columns, True for removed columns
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    graph = coo_matrix((np.ones(len(i), dtype=np.int8), (i, j)), shape=(n_cols, n_cols))
+    _, labels = connected_components(graph, directed=False)
+    _, name_ranks = np.unique(np.array([str(name) for name in names]), return_inverse=True)
+
+    # sorted by component, then by descending score, then by name: the first column of a component is kept
+    order = np.lexsort((name_ranks, -np.asarray(scores, dtype=np.float64), labels))
+    removed = np.ones(n_cols, dtype=bool)
+    removed[order[np.r_[True, labels[order][1:] != labels[order][:-1]]]] = False
+    return removed
+
+
+def modal_counts(values):
+    """
+    Number of occurrences of the most frequent non-missing value in every column of a 2D float array.
+    The columns are sorted once as a block, and the runs of equal values are measured for all columns at once
+    :param values:
+    :return: integer array with one count per column
+    """
+    n_rows, n_cols = values.shape
+    if n_rows == 0 or n_cols == 0:
+        return np.zeros(n_cols, dtype=np.int64)
+
+    block = np.array(values.T, dtype=np.float64, order='C')
+    block.sort(axis=1)  # missing values are sorted to the end of each column
+
+    starts = np.empty(block.shape, dtype=bool)
+    starts[:, 0] = True
+    np.not_equal(block[:, 1:], block[:, :-1], out=starts[:, 1:])  # every NaN starts its own run
+
+    run_starts = np.flatnonzero(starts)
+    run_lengths = np.diff(np.append(run_starts, block.size))
+    run_lengths[np.isnan(block.ravel()[run_starts])] = 0
+
+    first_run_of_column = np.searchsorted(run_starts, np.arange(n_cols) * n_rows)
+    return np.maximum.reduceat(run_lengths, first_run_of_column)
 
 
 class AlmostConstantFeatureRemover:
-    def __init__(self, max_count_percent=90, verbose=True, force_recompute=False):
+    def __init__(self, max_count_percent=90, verbose=True, force_recompute=False, method='vectorized',
+                 chunk_size=1000, n_jobs=1, backend='thread'):
         """
         If a column has a single value that makes up more than max_count_percent of the values, remove it
         :param max_count_percent:
         :param verbose:
         :param force_recompute:
+        :param method: 'vectorized' counts the values of the numeric columns in column blocks,
+        'per_column' calls value_counts on every column; non-numeric columns always use value_counts
+        :param chunk_size: number of columns sorted together by the vectorized method
+        :param n_jobs: number of workers processing chunks of columns in parallel for the vectorized method
+        :param backend: 'thread' or 'process'; with processes the numeric columns are put into shared memory
+
+        For pandas sparse columns and scipy.sparse matrices (with column indices as feature_columns) the fill value
+        is counted from the number of stored values, which are the only ones that are read
         """
+        if method not in ('vectorized', 'per_column'):
+            raise DataProcessorError("Unknown method '{}'".format(method))
         self.max_count_percent = max_count_percent
         self.columns_to_remove = []
         self.columns_to_leave = []
@@ -76,19 +677,95 @@ class AlmostConstantFeatureRemover:
         self.verbose = verbose
         self.force_recompute = force_recompute
         self.persistent = False
+        self.method = method
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+        self.backend = backend
 
     def __str__(self):
         return 'AlmostConstantFeatureRemover(max_count_percent={})'.format(self.max_count_percent)
 
+    def _too_frequent(self, count, len_df):
+        return 100 * count / len_df > self.max_count_percent
+
     def fit(self, df, feature_columns):
+        feature_columns = list(feature_columns)
+        removed = self._find_removed(df, feature_columns)
+        self.columns_to_remove = [col for col in feature_columns if col in removed]
+        return self._set_result(feature_columns)
+
+    def fit_incremental(self, df, feature_columns, previous_columns, previous_removed):
+        """
+        Update the decisions of a previous fit after features were added or removed, assuming that the data
+        of the features present in both is unchanged: only the new features are checked
+        :param df:
+        :param feature_columns:
+        :param previous_columns: feature_columns of the previous fit
+        :param previous_removed: columns removed by the previous fit
+        :return:
+        """
+        feature_columns = list(feature_columns)
+        previous_columns = set(previous_columns)
+        removed = set(previous_removed)
+        removed.update(self._find_removed(df, [col for col in feature_columns if col not in previous_columns]))
+        self.columns_to_remove = [col for col in feature_columns if col in removed]
+        return self._set_result(feature_columns)
+
+    def _find_removed(self, df, feature_columns):
+        if issparse(df):
+            from scipy import sparse
+            counts = sparse_modal_counts(sparse.csc_matrix(df)[:, feature_columns])
+            return {col for col, count in zip(feature_columns, counts) if self._too_frequent(count, df.shape[0])}
+
         len_df = len(df)
+        removed = set()
+        sparse_columns = [col for col in feature_columns if isinstance(df[col].dtype, pd.SparseDtype)]
+        for col in sparse_columns:
+            if self._too_frequent(sparse_column_modal_count(df[col].array), len_df):
+                removed.add(col)
+        sparse_columns = set(sparse_columns)
+
+        if self.method == 'vectorized':
+            numeric = [col for col in feature_columns
+                       if pd.api.types.is_numeric_dtype(df[col].dtype) and col not in sparse_columns]
+        else:
+            numeric = []
+        chunks = [slice(start, start + self.chunk_size) for start in range(0, len(numeric), self.chunk_size)]
+
+        if effective_n_jobs(self.n_jobs) == 1 or len(chunks) < 2:
+            for chunk in chunks:
+                values = df[numeric[chunk]].to_numpy(dtype=np.float64, na_value=np.nan)
+                removed.update(numeric[chunk][i] for i in self._find_almost_constant(values))
+        else:
+            # thread workers convert their own chunk of columns; process workers read a shared array that is
+            # filled column by column, so that no second full copy of the data exists
+            shared = None
+            if self.backend == 'process':
+                shared = SharedArray.empty((len_df, len(numeric)), fortran=True)
+                for i, col in enumerate(numeric):
+                    shared.array[:, i] = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+            try:
+                with get_executor(self.n_jobs, self.backend) as executor:
+                    futures = [executor.submit(_almost_constant_in_chunk, self, shared, chunk) if shared is not None
+                               else executor.submit(_almost_constant_in_chunk, self, df, numeric[chunk])
+                               for chunk in chunks]
+                    for chunk, future in zip(chunks, futures):
+                        removed.update(numeric[chunk][i] for i in future.result())
+            finally:
+                if shared is not None:
+                    shared.close()
 
+        numeric = set(numeric)
         for col in feature_columns:
-            count = df[col].value_counts().values[0]
-            if 100 * count / len_df > self.max_count_percent:
-                self.columns_to_remove.append(col)
+            if col not in numeric and col not in sparse_columns:
+                counts = df[col].value_counts().values
+                if len(counts) and self._too_frequent(counts[0], len_df):
+                    removed.add(col)
+        return removed
 
-        self.columns_to_leave = [x for x in feature_columns if x not in self.columns_to_remove]
+    def _set_result(self, feature_columns):
+        removed = set(self.columns_to_remove)
+        self.columns_to_leave = [col for col in feature_columns if col not in removed]
         self.fitted = True
 
         if self.verbose:
@@ -96,3 +773,112 @@ class AlmostConstantFeatureRemover:
                   + ' features found with a relative count percentage higher than ' + str(self.max_count_percent))
 
         return self.columns_to_leave, self.columns_to_remove
+
+    def n_counters(self):
+        """
+        Number of counters of the heavy-hitter summary of a column kept by partial_fit: a Misra-Gries summary
+        with k counters keeps every value that makes up more than 1 / (k + 1) of the rows, so all values that
+        are frequent enough to remove a column survive it
+        :return:
+        """
+        if self.max_count_percent <= 0:
+            return 1
+        return max(1, int(np.ceil(100 / self.max_count_percent)) - 1)
+
+    def partial_fit(self, df, feature_columns):
+        """
+        First pass over the chunks: merge the exact value counts of a chunk into a Misra-Gries summary of
+        at most n_counters() candidate values per column. The candidates are counted exactly by partial_verify
+        in a second pass, and the decision is made by finalize
+        :param df:
+        :param feature_columns: the same for every chunk
+        :return:
+        """
+        if not hasattr(self, '_candidates'):
+            self._stream_columns = list(feature_columns)
+            self._candidates = [None] * len(self._stream_columns)
+            self._stream_rows = 0
+            self._exact_counts = None
+        k = self.n_counters()
+        for i, col in enumerate(self._stream_columns):
+            counts = df[col].value_counts()
+            previous = self._candidates[i]
+            if previous is not None:
+                counts = previous.add(counts, fill_value=0)
+            if len(counts) > k:
+                # merging summaries: subtracting the (k + 1)-th largest count keeps at most k positive counters
+                counts = counts.sort_values(ascending=False)
+                counts = counts.iloc[:k] - counts.iloc[k]
+                counts = counts[counts > 0]
+            self._candidates[i] = counts
+        self._stream_rows += len(df)
+        return self
+
+    def partial_verify(self, df):
+        """
+        Second pass over the same chunks: count the candidate values of every column exactly
+        :param df:
+        :return:
+        """
+        if not hasattr(self, '_candidates'):
+            raise DataProcessorError('{} has not been given any chunks with partial_fit'.format(self))
+        if self._exact_counts is None:
+            self._exact_counts = [pd.Series(0, index=candidates.index) for candidates in self._candidates]
+        for i, col in enumerate(self._stream_columns):
+            if len(self._candidates[i]):
+                counts = df[col].value_counts().reindex(self._candidates[i].index, fill_value=0)
+                self._exact_counts[i] = self._exact_counts[i] + counts.to_numpy()
+        return self
+
+    def finalize(self, feature_columns=None):
+        """
+        Find the almost constant features from the exact counts of the candidates
+        :param feature_columns: subset of the columns passed to partial_fit, all of them if None
+        :return:
+        """
+        positions = _stream_positions(self, feature_columns)
+        if self._exact_counts is None:
+            raise DataProcessorError('{} needs a second pass over the chunks with partial_verify'.format(self))
+        self.columns_to_remove = [self._stream_columns[i] for i in positions
+                                  if len(self._exact_counts[i])
+                                  and self._too_frequent(self._exact_counts[i].max(), self._stream_rows)]
+        feature_columns = [self._stream_columns[i] for i in positions]
+        del self._candidates, self._exact_counts, self._stream_columns, self._stream_rows
+        return self._set_result(feature_columns)
+
+    def _find_almost_constant(self, values):
+        """
+        Indices of the columns of a 2D float array that have a too frequent value
+        :param values:
+        :return:
+        """
+        len_df, n_cols = values.shape
+        undecided = np.arange(n_cols)
+
+        # the most frequent value of a column occurs at most (count in the first n_head rows) + (len_df - n_head)
+        # times, so a column whose first rows are diverse enough cannot be removed, and is not sorted in full
+        n_allowed = int(np.floor(len_df * self.max_count_percent / 100))
+        n_head = 2 * (len_df - n_allowed)
+        if 0 < n_head < len_df:
+            head_counts = modal_counts(values[:n_head])
+            undecided = undecided[self._too_frequent(head_counts + (len_df - n_head), len_df)]
+
+        if len(undecided) == n_cols:
+            counts = modal_counts(values)
+        else:
+            counts = modal_counts(values[:, undecided])
+        return undecided[self._too_frequent(counts, len_df)]
+
+
+def _almost_constant_in_chunk(remover, values, chunk):
+    """
+    :param remover:
+    :param values: SharedArray with all numeric columns, or the dataframe
+    :param chunk: slice of the shared columns, or the names of the columns of the dataframe
+    :return: indices within the chunk of the almost constant columns
+    """
+    if isinstance(values, SharedArray):
+        values = values.array[:, chunk]
+    else:
+        values = values[chunk].to_numpy(dtype=np.float64, na_value=np.nan)
+    return remover._find_almost_constant(values)
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import pathlib
+import pickle
+import tempfile
+import uuid
+import warnings
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+from .exceptions import DataProcessorError
+
+
+FORMAT_VERSION = 1
+
+
+@contextmanager
+def atomic_open(path, mode: str='w'):
+    """
+    Open a temporary file in the directory of path; it replaces path when the block exits without an error,
+    so that readers see either the old or the new content, never a partial file
+    :param path:
+    :param mode: 'w' or 'wb'
+    :return: file object
+    """
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.' + path.name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        pathlib.Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+def new_run_id(prefix: str=''):
+    """
+    Name of a run: the time of day for readability and a random suffix, so that runs started
+    within the same second (e.g. by concurrent workers) do not collide
+    :param prefix:
+    :return:
+    """
+    return prefix + str(datetime.now()).replace(':', '_').replace(' ', '_')[5:19] + '_' + uuid.uuid4().hex[:8]
+
+
+class RunStore:
+    """
+    Versioned store of saved runs in dataprocessor_files/runs. Every run is a directory with
+    - run.json: format version, run metadata and the name of its column dictionary;
+    - features.npz: every feature list as an array of indexes into the column dictionary;
+    - state.pkl: the fitted removers and transforms (optional).
+    Column dictionaries are stored once in runs/columns, named by the hash of their content, and shared by all
+    runs with the same columns. All files are written atomically, and a run is never modified after it is written
+    """
+    def __init__(self, path: str):
+        """
+
+        :param path: base path of the DataProcessor
+        """
+        if not path.endswith('/'):
+            path += '/'
+        self.base_path = path
+        self.relative_path = 'dataprocessor_files/runs/'
+
+    def _write_columns(self, columns):
+        text = json.dumps(columns, default=str)
+        name = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+        f = pathlib.Path(self.base_path + self.relative_path + 'columns/' + name + '.json')
+        if not f.exists():  # identical content under the same name, concurrent writers do not conflict
+            with atomic_open(f, 'w') as fh:
+                fh.write(text)
+        return name
+
+    def write_run(self, run_id: str, columns, feature_lists, metadata=None, state=None):
+        """
+        Write a new run
+        :param run_id: e.g. from new_run_id
+        :param columns: column dictionary, names that are not in it but appear in the lists are appended
+        :param feature_lists: dict of name to list of columns
+        :param metadata: JSON-serializable dict
+        :param state: fitted state; if it cannot be pickled (e.g. it holds a lambda), the run is written without it
+        and a warning is issued
+        :return: path of the run relative to the base path
+        """
+        columns = list(columns)
+        positions = {col: i for i, col in enumerate(columns)}
+        for features in feature_lists.values():
+            for col in features:
+                if col not in positions:
+                    positions[col] = len(columns)
+                    columns.append(col)
+
+        run_path = self.relative_path + run_id + '/'
+        full_path = self.base_path + run_path
+        if pathlib.Path(full_path).exists():
+            raise DataProcessorError("Run '{}' already exists".format(run_id))
+        if state is not None:
+            # serialized before anything is written, so that a failure leaves no partial run
+            try:
+                state = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, AttributeError, TypeError) as e:
+                warnings.warn('The fitted state of run {} cannot be pickled, it is saved without it: {}'.format(
+                    run_id, e))
+                state = None
+
+        with atomic_open(full_path + 'features.npz', 'wb') as f:
+            np.savez(f, **{name: np.array([positions[col] for col in features], dtype=np.uint32)
+                           for name, features in feature_lists.items()})
+        if state is not None:
+            with atomic_open(full_path + 'state.pkl', 'wb') as f:
+                f.write(state)
+        run = {'format': FORMAT_VERSION, 'run': run_id, 'columns': self._write_columns(columns),
+               'lists': list(feature_lists), 'state': state is not None, 'metadata': metadata or {}}
+        with atomic_open(full_path + 'run.json', 'w') as f:  # written last, marks the run as complete
+            json.dump(run, f)
+        return run_path
+
+    def read_run(self, run_path: str):
+        """
+        Metadata of a run
+        :param run_path: as returned by write_run
+        :return: dict
+        """
+        try:
+            with open(self.base_path + run_path + 'run.json', 'r') as f:
+                run = json.load(f)
+        except FileNotFoundError:
+            raise DataProcessorError("No saved run found at '{}'".format(run_path))
+        if run['format'] > FORMAT_VERSION:
+            raise DataProcessorError('Run {} has format version {}, only versions up to {} can be read'.format(
+                run['run'], run['format'], FORMAT_VERSION))
+        return run
+
+    def read_feature_lists(self, run_path: str):
+        """
+        Feature lists of a run
+        :param run_path:
+        :return: dict of name to list of columns
+        """
+        run = self.read_run(run_path)
+        with open(self.base_path + self.relative_path + 'columns/' + run['columns'] + '.json', 'r') as f:
+            columns = json.load(f)
+        with np.load(self.base_path + run_path + 'features.npz') as indexes:
+            return {name: [columns[i] for i in indexes[name].tolist()] for name in run['lists']}
+
+    def read_state(self, run_path: str):
+        """
+        Fitted state of a run
+        :param run_path:
+        :return:
+        """
+        if not self.read_run(run_path)['state']:
+            raise DataProcessorError('No fitted state was saved with run {}'.format(run_path))
+        with open(self.base_path + run_path + 'state.pkl', 'rb') as f:
+            return pickle.load(f)
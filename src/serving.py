@@ -0,0 +1,187 @@
+import pathlib
+import queue
+from collections import deque
+import threading
+from concurrent.futures import Future
+import numpy as np
+import pandas as pd
+from .dataprocessor import DataProcessor
+from .exceptions import DataProcessorError
+from .runstore import new_run_id
+from .transforms import TransformChain
+
+
+_STOP = object()
+
+
+class PredictionService:
+    """
+    Scores batches of rows with a saved, fitted pipeline. The run is loaded once: the features are extracted
+    from every batch, transformed by the restored transforms and passed to a fitted predictor, and the predictions
+    are appended to a CSV file in dataprocessor_files/output/predictions as the batches are scored.
+
+    predict scores a batch in the calling thread; submit puts it into a bounded queue that is consumed by
+    n_workers threads, blocking while the queue is full, and returns a Future
+    """
+    def __init__(self, path: str, predictor, predict_proba=False, use_features: str='selected', n_workers: int=1,
+                 queue_size: int=16, name=None, write=True, verbose=False):
+        """
+
+        :param path: base path of the saved DataProcessor
+        :param predictor: fitted estimator with predict (or predict_proba)
+        :param predict_proba: predict class probabilities; for two classes only the probability of the second one
+        :param use_features: the features the predictor was fitted on
+        :param n_workers: number of threads scoring submitted batches
+        :param queue_size: maximum number of submitted batches waiting to be scored
+        :param name: name of the predictions file, unique if None
+        :param write: if False, the predictions are only returned
+        :param verbose:
+        """
+        self.dataprocessor = DataProcessor(path, None, verbose=verbose, use_cache=False, restore=True)
+        self.features = self.dataprocessor.return_features_list(use_features)
+        self.predictor = predictor
+        self.predict_proba = predict_proba
+        self.n_workers = n_workers
+        self.queue_size = queue_size
+        self.write = write
+
+        self.name = name if name is not None else 'service_' + new_run_id()
+        self.predictions_file = (self.dataprocessor.base_path + 'dataprocessor_files/output/predictions/'
+                                 + self.name + '.csv')
+        self.n_batches = 0
+        self.n_rows = 0
+        self._write_lock = threading.Lock()
+        self._queue = None
+        self._workers = []
+
+    def _score(self, batch):
+        missing = [col for col in self.features if col not in batch.columns]
+        if missing:
+            raise DataProcessorError('Batch is missing {} features, e.g. {}'.format(len(missing), missing[:5]))
+        values = TransformChain.extract(batch, self.features)
+        TransformChain(self.dataprocessor.transforms, verbose=False).transform(values)
+        if self.predict_proba:
+            predictions = self.predictor.predict_proba(values)
+            if predictions.shape[1] == 2:
+                predictions = predictions[:, 1]
+        else:
+            predictions = self.predictor.predict(values)
+        return predictions
+
+    def _write(self, predictions, index):
+        with self._write_lock:
+            if self.write:
+                if self.n_batches == 0:
+                    pathlib.Path(self.predictions_file).parent.mkdir(parents=True, exist_ok=True)
+                pd.DataFrame(predictions, index=index).to_csv(self.predictions_file, mode='a',
+                                                              header=self.n_batches == 0)
+            self.n_batches += 1
+            self.n_rows += len(index)
+
+    def predict(self, batch):
+        """
+        Score a batch in the calling thread
+        :param batch: dataframe with (at least) the feature columns
+        :return: predictions
+        """
+        with self.dataprocessor.profiler.stage('predict', str(self.predictor), *batch.shape):
+            predictions = self._score(batch)
+        self._write(predictions, batch.index)
+        return predictions
+
+    def start(self):
+        """
+        Start the worker threads that score submitted batches
+        :return:
+        """
+        if self._queue is None:
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(self.n_workers)]
+            for worker in self._workers:
+                worker.start()
+        return self
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch, future = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self.predict(batch))
+                except BaseException as e:
+                    future.set_exception(e)
+
+    def submit(self, batch):
+        """
+        Queue a batch for scoring, waiting while the queue is full
+        :param batch:
+        :return: Future with the predictions
+        """
+        self.start()
+        future = Future()
+        self._queue.put((batch, future))
+        return future
+
+    def close(self):
+        """
+        Score the batches still in the queue and stop the workers
+        :return:
+        """
+        if self._queue is not None:
+            for _ in self._workers:
+                self._queue.put(_STOP)
+            for worker in self._workers:
+                worker.join()
+            self._queue = None
+            self._workers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def client(self):
+        return LocalClient(self)
+
+
+class LocalClient:
+    """
+    In-process client of a PredictionService, e.g. for tests
+    """
+    def __init__(self, service: PredictionService):
+        self.service = service
+
+    def predict(self, batch):
+        """
+        Score a batch through the queue of the service and wait for the result
+        :param batch:
+        :return: predictions
+        """
+        return self.service.submit(batch).result()
+
+    def predict_batches(self, batches):
+        """
+        Score an iterable of batches through the queue, with up to the queue size of them in flight
+        :param batches:
+        :return: generator of the predictions, in the order of the batches
+        """
+        pending = deque()
+        for batch in batches:
+            pending.append(self.service.submit(batch))
+            if len(pending) > self.service.queue_size:
+                yield pending.popleft().result()
+        for future in pending:
+            yield future.result()
+
+    def predict_frame(self, df, batch_size: int):
+        """
+        Score a dataframe in micro-batches of batch_size rows
+        :param df:
+        :param batch_size:
+        :return: predictions for all rows
+        """
+        batches = (df.iloc[start:start + batch_size] for start in range(0, len(df), batch_size))
+        return np.concatenate(list(self.predict_batches(batches)))
@@ -0,0 +1,231 @@
+import numpy as np
+import pandas as pd
+from .exceptions import DataProcessorError
+
+
+def issparse(X):
+    """
+    True for scipy.sparse matrices and arrays (scipy is only imported if it is installed)
+    :param X:
+    :return:
+    """
+    try:
+        from scipy import sparse
+    except ImportError:
+        return False
+    return sparse.issparse(X)
+
+
+def is_sparse_column(series):
+    return isinstance(series.dtype, pd.SparseDtype)
+
+
+def has_sparse_columns(df, columns=None):
+    """
+    True if df is a scipy.sparse matrix, or any of the given columns of a dataframe has a pandas SparseDtype
+    :param df:
+    :param columns: all columns if None
+    :return:
+    """
+    if issparse(df):
+        return True
+    if not isinstance(df, pd.DataFrame):
+        return False
+    dtypes = df.dtypes if columns is None else df.dtypes[list(columns)]
+    return any(isinstance(dtype, pd.SparseDtype) for dtype in dtypes)
+
+
+def _stored(array):
+    """
+    Stored values (as floats) and their row positions of a pandas SparseArray
+    """
+    return array.sp_values.astype(np.float64), array.sp_index.to_int_index().indices
+
+
+def to_csc(df, columns):
+    """
+    CSC matrix with the given columns of a dataframe or a scipy.sparse matrix, built from the stored values only.
+    The fill value of a pandas sparse column is subtracted, so that it becomes an implicit zero; dense columns
+    store their non-zero values. Correlations do not change under these shifts
+    :param df: dataframe or scipy.sparse matrix
+    :param columns: column names of a dataframe, column indices of a matrix
+    :return: csc matrix, or None if there are missing values (stored NaN, or NaN as the fill value)
+    """
+    from scipy import sparse
+
+    if issparse(df):
+        X = sparse.csc_matrix(df)[:, list(columns)].astype(np.float64)
+        return None if np.isnan(X.data).any() else X
+
+    data, indices, indptr = [], [], [0]
+    for col in columns:
+        series = df[col]
+        if is_sparse_column(series):
+            fill = float(series.array.fill_value)
+            values, rows = _stored(series.array)
+            values = values - fill
+        else:
+            fill = 0.0
+            column = series.to_numpy(dtype=np.float64, na_value=np.nan)
+            rows = np.flatnonzero(column)
+            values = column[rows]
+        if np.isnan(fill) or np.isnan(values).any():
+            return None
+        data.append(values)
+        indices.append(rows)
+        indptr.append(indptr[-1] + len(rows))
+    data = np.concatenate(data) if data else np.zeros(0)
+    indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+    return sparse.csc_matrix((data, indices, np.asarray(indptr)), shape=(len(df), len(columns)))
+
+
+def correlated_pairs(X, threshold):
+    """
+    Pairs of columns (i, j), i < j, of a sparse matrix with |corr| > threshold.
+    The sums, sums of squares and the cross-products (X.T @ X) are computed from the stored values only,
+    so the memory use scales with the number of stored values and of pairs of columns that share a row.
+    Two columns without a common stored row have corr = -a_i * a_j with a = |sum| / sqrt(n * centered sum of
+    squares); such pairs are only checked among the columns where this bound can exceed the threshold
+    :param X: scipy.sparse matrix without missing values
+    :param threshold:
+    :return: arrays i, j
+    """
+    from scipy import sparse
+
+    X = sparse.csc_matrix(X, dtype=np.float64)
+    n, p = X.shape
+    if n < 2 or p < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    s = np.asarray(X.sum(axis=0)).ravel()
+    ss = np.asarray(X.multiply(X).sum(axis=0)).ravel()
+    var = ss - s * s / n  # n times the variance
+    valid = var > 1e-12 * np.maximum(ss, 1e-300)
+    scale = np.where(valid, 1 / np.sqrt(np.where(valid, var, 1)), 0.0)
+
+    gram = sparse.triu(X.T @ X, k=1).tocoo()
+    i, j = gram.row.astype(np.int64), gram.col.astype(np.int64)
+    corr = (gram.data - s[i] * s[j] / n) * scale[i] * scale[j]
+    found = np.abs(corr) > threshold
+    pairs_i, pairs_j = [i[found]], [j[found]]
+
+    a = np.abs(s) * scale / np.sqrt(n)
+    candidates = np.flatnonzero(a * a.max() > threshold)
+    if len(candidates) > 1:
+        sub = X[:, candidates]
+        products = (sub.T @ sub).toarray()
+        corr = (products - np.outer(s[candidates], s[candidates]) / n) * np.outer(scale[candidates],
+                                                                                 scale[candidates])
+        ci, cj = np.nonzero(np.triu(np.abs(corr), k=1) > threshold)
+        pairs_i.append(candidates[ci])
+        pairs_j.append(candidates[cj])
+
+    codes = np.unique(np.concatenate(pairs_i) * p + np.concatenate(pairs_j))
+    return codes // p, codes % p
+
+
+def _modal_count_of_values(values):
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return 0
+    _, counts = np.unique(values, return_counts=True)
+    return counts.max()
+
+
+def sparse_column_modal_count(array):
+    """
+    Number of occurrences of the most frequent non-missing value of a pandas SparseArray,
+    counting the fill value from the number of stored values instead of materializing it
+    :param array:
+    :return:
+    """
+    values, _ = _stored(array)
+    fill = float(array.fill_value)
+    if np.isnan(fill):
+        return _modal_count_of_values(values)
+    is_fill = values == fill
+    return max(len(array) - array.sp_index.npoints + int(is_fill.sum()), _modal_count_of_values(values[~is_fill]))
+
+
+def modal_counts(X):
+    """
+    Number of occurrences of the most frequent non-missing value in every column of a scipy.sparse matrix.
+    The zeros are counted from the number of stored non-zero values; the stored values are sorted by column
+    and value once, and the runs of equal values are measured for all columns at once
+    :param X:
+    :return: integer array with one count per column
+    """
+    from scipy import sparse
+
+    X = sparse.csc_matrix(X, dtype=np.float64)
+    n_rows, n_cols = X.shape
+    columns = np.repeat(np.arange(n_cols), np.diff(X.indptr))
+    values = X.data
+    zeros = n_rows - np.bincount(columns[values != 0], minlength=n_cols)
+
+    keep = (values != 0) & ~np.isnan(values)
+    values, columns = values[keep], columns[keep]
+    order = np.lexsort((values, columns))
+    values, columns = values[order], columns[order]
+
+    counts = np.zeros(n_cols, dtype=np.int64)
+    if len(values):
+        starts = np.empty(len(values), dtype=bool)
+        starts[0] = True
+        starts[1:] = (values[1:] != values[:-1]) | (columns[1:] != columns[:-1])
+        run_starts = np.flatnonzero(starts)
+        run_lengths = np.diff(np.append(run_starts, len(values)))
+        np.maximum.at(counts, columns[run_starts], run_lengths)
+    return np.maximum(counts, zeros)
+
+
+def to_frame(X, columns):
+    """
+    Dense dataframe with the given columns of a scipy.sparse matrix, for the methods that need dense data
+    :param X:
+    :param columns: column indices, also used as the column names
+    :return:
+    """
+    from scipy import sparse
+
+    columns = list(columns)
+    return pd.DataFrame(sparse.csc_matrix(X)[:, columns].toarray(), columns=columns)
+
+
+def log_transform_stored(X, columns, shifts, copy=True):
+    """
+    Apply np.log1p(x - shift) to the stored values of the given columns of a scipy.sparse matrix.
+    The implicit zeros are unchanged, which is only exact for columns whose shift is zero
+    :param X:
+    :param columns: column indices
+    :param shifts: one per column
+    :param copy: if False, a float64 CSR or CSC matrix is transformed in place
+    :return:
+    """
+    shifts = np.asarray(shifts, dtype=np.float64)
+    if np.any(shifts != 0):
+        raise DataProcessorError('A log transform with a non-zero minimum does not keep the zeros of a '
+                                 'scipy.sparse matrix, use a dense array or pandas sparse columns')
+    if copy or X.format not in ('csr', 'csc') or X.dtype != np.float64:
+        X = X.tocsc().astype(np.float64, copy=True)
+
+    selected = np.zeros(X.shape[1], dtype=bool)
+    selected[list(columns)] = True
+    entry_columns = X.indices if X.format == 'csr' else np.repeat(np.arange(X.shape[1]), np.diff(X.indptr))
+    np.log1p(X.data, out=X.data, where=selected[entry_columns])
+    return X
+
+
+def log_transform_column(array, shift, dtype=np.float64):
+    """
+    Apply np.log1p(x - shift) to a pandas SparseArray: to the stored values and to the fill value only
+    :param array:
+    :param shift:
+    :param dtype:
+    :return: SparseArray with the same sparse index
+    """
+    dtype = np.dtype(dtype)
+    values = np.log1p(array.sp_values.astype(dtype) - dtype.type(shift))
+    fill = np.log1p(dtype.type(array.fill_value) - dtype.type(shift))
+    return pd.arrays.SparseArray(values, sparse_index=array.sp_index, fill_value=fill,
+                                 dtype=pd.SparseDtype(dtype, fill))
@@ -1,18 +1,62 @@
+import contextlib
+import inspect
 import numpy as np
-from sklearn.base import BaseEstimator, TransformerMixin
 import pandas as pd
 from .exceptions import DataProcessorError
-from sklearn.exceptions import NotFittedError
+from .sparse import has_sparse_columns, is_sparse_column, issparse, log_transform_column, log_transform_stored
 
 
-class LogTransformer(BaseEstimator, TransformerMixin):
+class TransformerParamsMixin:
+    """
+    The parameter handling of sklearn's BaseEstimator and the fit_transform of TransformerMixin, which is all
+    the transforms need to work with clone and pipelines, without importing sklearn with this module
+    """
+    @classmethod
+    def _get_param_names(cls):
+        parameters = inspect.signature(cls.__init__).parameters.values()
+        return sorted(p.name for p in parameters if p.name != 'self' and p.kind != p.VAR_KEYWORD)
+
+    def get_params(self, deep=True):
+        return {name: getattr(self, name) for name in self._get_param_names()}
+
+    def set_params(self, **params):
+        valid = self._get_param_names()
+        for name, value in params.items():
+            if name not in valid:
+                raise ValueError('Invalid parameter {} for {}'.format(name, type(self).__name__))
+            setattr(self, name, value)
+        return self
+
+    def fit_transform(self, X, y=None, **fit_params):
+        return self.fit(X, **fit_params).transform(X)
+
+
+class LogTransformer(TransformerParamsMixin):
     """
     If the ratio of max(abs(X[:, col]))/min(abs(X[:, col])) exceeds a certain threshold,
     replace the values in the column with a logarithm: X[i, col] = np.log(1 + X[i, col] - min(X[:, col]))
+
+    The whole block is transformed at once with a masked np.log1p. With copy=True the result is a single new
+    float array (or a dataframe on top of it); with copy=False a float numpy array of the output dtype is
+    transformed in place, and for a dataframe only the transformed columns are replaced.
+
+    Sparse data is transformed on its stored values only: pandas sparse columns also transform their fill value
+    and stay sparse (the other columns of such a frame keep their dtypes), scipy.sparse matrices keep their
+    implicit zeros, so their transformed columns must have a minimum of zero.
     """
-    def __init__(self, threshold=1e5):
+    def __init__(self, threshold=1e5, copy=True, dtype=None):
+        """
+
+        :param threshold:
+        :param copy: if False, transform the input in place instead of returning a transformed copy
+        :param dtype: float dtype of the output; if None, float32 input stays float32 and everything else
+        becomes float64
+        """
         self.fitted = False
         self.threshold = threshold
+        self.copy = copy
+        self.dtype = dtype
+        self.persistent = False  # fitting is a single pass over the data, as cheap as fingerprinting it
 
     def __str__(self):
         return 'LogTransformer(threshold={})'.format(self.threshold)
@@ -22,55 +66,215 @@ class LogTransformer(BaseEstimator, TransformerMixin):
             del self.columns_
             del self.column_names_
             del self.min_vals_
+            del self.data_min_
+            del self.data_max_
             self.fitted = False
 
     def fit(self, X):
         self._reset()
-        self.columns_ = []
-        self.column_names_ = []
-        self.min_vals_ = []
+        return self.partial_fit(X)
 
-        if type(X) == pd.DataFrame:
-            Y = X.values
+    def partial_fit(self, X):
+        """
+        Update the column minima and maxima with a chunk of rows, and re-select the columns to transform
+        :param X:
+        :return:
+        """
+        if issparse(X):
+            min_vals = X.min(axis=0).toarray().ravel().astype(np.float64)
+            max_vals = X.max(axis=0).toarray().ravel().astype(np.float64)
+        elif type(X) == pd.DataFrame and has_sparse_columns(X):
+            # a reduction over the whole frame would concatenate the sparse results with different fill values
+            min_vals = np.array([X.iloc[:, i].min(skipna=False) for i in range(X.shape[1])], dtype=np.float64)
+            max_vals = np.array([X.iloc[:, i].max(skipna=False) for i in range(X.shape[1])], dtype=np.float64)
+        elif type(X) == pd.DataFrame:
+            # column by column, so that a frame with several dtypes is not copied into one block
+            min_vals = X.min(axis=0, skipna=False).to_numpy(dtype=np.float64)
+            max_vals = X.max(axis=0, skipna=False).to_numpy(dtype=np.float64)
         else:
-            Y = X
+            min_vals = np.min(X, axis=0).astype(np.float64)
+            max_vals = np.max(X, axis=0).astype(np.float64)
 
-        min_vals = np.min(Y, axis=0)
-        max_vals = np.max(Y, axis=0)
+        if hasattr(self, 'data_min_'):
+            if len(min_vals) != len(self.data_min_):
+                raise DataProcessorError('LogTransformer was fitted on {} columns, got {}'.format(
+                    len(self.data_min_), len(min_vals)))
+            min_vals = np.minimum(self.data_min_, min_vals)
+            max_vals = np.maximum(self.data_max_, max_vals)
+        self.data_min_ = min_vals
+        self.data_max_ = max_vals
 
-        zero_min = np.where(min_vals == 0)[0]
-        non_zero_min = np.where(min_vals != 0)[0]
-        large_max = np.where(max_vals > self.threshold)[0]
+        zero_min = min_vals == 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            large_ratio = np.abs(max_vals / np.where(zero_min, 1, min_vals)) > self.threshold
+        selected = np.where(zero_min, max_vals > self.threshold, large_ratio)
 
-        large_max_zero_min = [x for x in zero_min if x in large_max]
+        self.columns_ = np.flatnonzero(selected).tolist()
+        self.min_vals_ = min_vals[selected].tolist()
+        self.column_names_ = [X.columns[i] for i in self.columns_] if type(X) == pd.DataFrame else []
 
-        if large_max_zero_min:
-            for i in large_max_zero_min:
-                self.columns_.append(i)
-                self.min_vals_.append(0)
+        # broadcast over rows by the masked ufuncs in transform
+        self._mask = selected
+        self._shift = np.where(selected, min_vals, 0.0)
+        self.fitted = True
 
-        for i in non_zero_min:
-            if abs(max_vals[i] / min_vals[i]) > self.threshold:
-                self.columns_.append(i)
-                self.min_vals_.append(min_vals[i])
+        return self
 
-        if type(X) == pd.DataFrame:
-            self.column_names_ = [X.columns[i] for i in self.columns_]
+    def _output_dtype(self, dtypes):
+        if self.dtype is not None:
+            return np.dtype(self.dtype)
+        if len(dtypes) and all(dtype == np.float32 for dtype in dtypes):
+            return np.dtype(np.float32)
+        return np.dtype(np.float64)
 
-        self.fitted = True
+    def transform(self, X, copy=None):
+        """
+        Apply the logarithm to the selected columns
+        :param X:
+        :param copy: overrides the copy parameter of the transformer
+        :return:
+        """
+        if not self.fitted:
+            from sklearn.exceptions import NotFittedError
+            raise NotFittedError('This LogTransformer has not been fitted yet')
+        if X.shape[1] != len(self._mask):
+            raise DataProcessorError('LogTransformer was fitted on {} columns, got {}'.format(
+                len(self._mask), X.shape[1]))
+        copy = self.copy if copy is None else copy
 
-        return self
+        if issparse(X):
+            return log_transform_stored(X, self.columns_, self.min_vals_, copy)
+        if type(X) == pd.DataFrame and has_sparse_columns(X):
+            return self._transform_sparse_frame(X, copy)
+        if type(X) == pd.DataFrame:
+            dtype = self._output_dtype(X.dtypes)
+            if not copy:
+                if not self.columns_:
+                    return X
+                # only the transformed columns are converted and replaced, the rest of the frame is left alone
+                values = X.iloc[:, self.columns_].to_numpy(dtype=dtype, copy=True)
+                self._apply(values, np.asarray(self.min_vals_, dtype=dtype))
+                X.isetitem(self.columns_, values)
+                return X
+            values = X.to_numpy(dtype=dtype, copy=True)
+            self._apply(values, self._shift.astype(dtype), self._mask)
+            return pd.DataFrame(values, index=X.index, columns=X.columns, copy=False)
+
+        dtype = self._output_dtype([X.dtype])
+        if copy or X.dtype != dtype or not X.flags.writeable:
+            X = np.array(X, dtype=dtype, copy=True)
+        self._apply(X, self._shift.astype(dtype), self._mask)
+        return X
 
-    def transform(self, X):
-        if self.fitted:
-            if type(X) == pd.DataFrame:
-                Y = X.values
+    def _transform_sparse_frame(self, X, copy):
+        dtype = self._output_dtype([X.dtypes.iloc[i].subtype if isinstance(X.dtypes.iloc[i], pd.SparseDtype)
+                                    else X.dtypes.iloc[i] for i in self.columns_])
+        if copy:
+            X = X.copy()
+        for position, shift in zip(self.columns_, self.min_vals_):
+            column = X.iloc[:, position]
+            if is_sparse_column(column):
+                values = log_transform_column(column.array, shift, dtype)
             else:
-                Y = X
+                values = column.to_numpy(dtype=dtype, copy=True)
+                self._apply(values, dtype.type(shift))
+            X.isetitem(position, values)
+        return X
+
+    @staticmethod
+    def _apply(values, shift, mask=True):
+        np.subtract(values, shift, out=values, where=mask)
+        np.log1p(values, out=values, where=mask)
+
+
+class TransformChain:
+    """
+    Applies a sequence of transforms to a single contiguous float array: the columns are copied out of the
+    dataframe once, every transform works on the same array in place (transforms whose transform method takes
+    a copy argument are called with copy=False), and the result is written back once.
+    Steps that return a new array instead are reported in copied_steps_ and their output is copied back
+    into the array. With a profiler, the fit and transform of every step are recorded as separate stages.
+    """
+    def __init__(self, transforms, verbose=True, profiler=None):
+        self.transforms = transforms
+        self.verbose = verbose
+        self.profiler = profiler
+        self.copied_steps_ = []
+
+    @staticmethod
+    def extract(df, columns, dtype=np.float64):
+        """
+        Copy the columns of a dataframe into one column-major float array
+        :param df:
+        :param columns:
+        :param dtype:
+        :return:
+        """
+        values = np.empty((len(df), len(columns)), dtype=dtype, order='F')
+        for i, col in enumerate(columns):
+            values[:, i] = df[col].to_numpy()
+        return values
+
+    @staticmethod
+    def frame(values, columns):
+        """
+        Dataframe on top of values, without copying them
+        :param values:
+        :param columns:
+        :return:
+        """
+        return pd.DataFrame(values, columns=columns, copy=False)
+
+    def _stage(self, name, transform, values):
+        if self.profiler is None:
+            return contextlib.nullcontext({})
+        return self.profiler.stage(name, str(transform), values.shape[0], values.shape[1])
 
-            for i, col in enumerate(self.columns_):
-                Y[:, col] = np.log1p(Y[:, col] - self.min_vals_[i])
+    def _apply(self, transform, values):
+        with self._stage('transform', transform, values) as record:
+            self._transform(transform, values, record)
 
-            return X
+    def _transform(self, transform, values, record):
+        if 'copy' in inspect.signature(transform.transform).parameters:
+            result = transform.transform(values, copy=False)
         else:
-            raise NotFittedError('This LogTransformer has not been fitted yet')
+            result = transform.transform(values)
+
+        result = np.asarray(result)
+        if not np.shares_memory(result, values):
+            self.copied_steps_.append(str(transform))
+            record['copied'] = True
+            if self.verbose:
+                print('{} did not run in place, its output is copied back'.format(transform))
+            values[...] = result
+
+    def fit_transform(self, values, columns, fit_step=None):
+        """
+        Fit every transform on the output of the previous ones and apply it, in place
+        :param values: float array, e.g. from extract
+        :param columns: column names, the transforms are fitted on a dataframe view with these columns
+        :param fit_step: optional callable(i, transform, X) returning the fitted transform for step i,
+        by default transform.fit(X)
+        :return: values
+        """
+        self.copied_steps_ = []
+        for i, transform in enumerate(self.transforms):
+            X = self.frame(values, columns)
+            with self._stage('fit', transform, values):
+                if fit_step is None:
+                    transform.fit(X)
+                else:
+                    self.transforms[i] = transform = fit_step(i, transform, X)
+            self._apply(transform, values)
+        return values
+
+    def transform(self, values):
+        """
+        Apply the fitted transforms, in place
+        :param values: float array, e.g. from extract
+        :return: values
+        """
+        self.copied_steps_ = []
+        for transform in self.transforms:
+            self._apply(transform, values)
+        return values
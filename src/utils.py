@@ -1,10 +1,15 @@
 from typing import List
+import numpy as np
 import pandas as pd
+from .exceptions import DataProcessorError
+from .profiling import Profiler
 
 
 def load_and_merge_dataframes(path: str, keys: List[str], merge_on: str='fname',
                               exclude_cols_all=None,
-                              exclude_cols_except_first=None):
+                              exclude_cols_except_first=None,
+                              streaming=False, chunksize: int=100000,
+                              output_path=None, output_key: str='merged', min_itemsize=None, profiler=None):
     """
     Load dataframes from a HDF5 table, merge into one, while dropping some columns
     :param path:
@@ -12,13 +17,53 @@ def load_and_merge_dataframes(path: str, keys: List[str], merge_on: str='fname',
     :param merge_on:
     :param exclude_cols_all:
     :param exclude_cols_except_first:
-    :return:
+    :param streaming: if True, exclude_cols_all is dropped while reading (from every key, before the merge),
+    and the keys are merged with a single join on merge_on instead of pairwise merges. From keys stored in table
+    format only the needed columns are kept: data columns are read on their own, the other columns are read
+    chunksize rows at a time (PyTables reads all columns of a row), so the excluded columns take the memory
+    of one chunk at most. Keys in fixed format are read in full
+    :param chunksize: number of rows read at a time in streaming mode, and merged at a time when writing
+    to output_path
+    :param output_path: if set, the merged dataframe is built chunk by chunk and appended to this HDF5 file
+    under output_key instead of being returned; all keys must be stored in table format and merge_on must be
+    unique in each of them. Implies streaming
+    :param output_key:
+    :param min_itemsize: passed to HDFStore.append when writing to output_path, on top of the widths of the string
+    columns in the keys, which are reserved by default so that longer strings in later chunks fit
+    :param profiler: Profiler that records the load as a stage, with the size of the merged dataframe
+    :return: the merged dataframe, or output_path if it was set
     """
+    if profiler is None:
+        profiler = Profiler()
+    with profiler.stage('load_and_merge_dataframes', path, keys=list(keys), streaming=streaming) as record:
+        result = _load_and_merge(path, keys, merge_on, exclude_cols_all, exclude_cols_except_first, streaming,
+                                 chunksize, output_path, output_key, min_itemsize)
+        if profiler.enabled:
+            if output_path is None:
+                record['rows'], record['columns'] = result.shape
+            else:
+                with pd.HDFStore(output_path, mode='r') as store:
+                    storer = store.get_storer(output_key)
+                    record['rows'], record['columns'] = storer.nrows, len(storer.non_index_axes[0][1])
+    return result
+
+
+def _load_and_merge(path, keys, merge_on, exclude_cols_all, exclude_cols_except_first, streaming, chunksize,
+                    output_path, output_key, min_itemsize):
     if exclude_cols_except_first is None:
         exclude_cols_except_first = []
     if exclude_cols_all is None:
         exclude_cols_all = []
 
+    if streaming or output_path is not None:
+        with pd.HDFStore(path, mode='r') as store:
+            columns = _columns_to_read(store, keys, merge_on, exclude_cols_all, exclude_cols_except_first)
+            if output_path is None:
+                return _join_dataframes(store, keys, columns, merge_on, exclude_cols_all, exclude_cols_except_first,
+                                        chunksize)
+            _merge_to_store(store, keys, columns, merge_on, chunksize, output_path, output_key, min_itemsize)
+            return output_path
+
     df_list = [pd.read_hdf(path, key=key) for key in keys]
 
     if len(df_list) == 1:
@@ -37,3 +82,161 @@ def load_and_merge_dataframes(path: str, keys: List[str], merge_on: str='fname',
         base_df.drop(remove_cols, axis=1, inplace=True)
 
     return base_df
+
+
+def _excluded_columns(i, merge_on, exclude_cols_all, exclude_cols_except_first):
+    excluded = set(exclude_cols_all)
+    if i > 0:
+        excluded.update(exclude_cols_except_first)
+    excluded.discard(merge_on)
+    return excluded
+
+
+def _columns_to_read(store, keys, merge_on, exclude_cols_all, exclude_cols_except_first):
+    """
+    Columns to read from each key, with the excluded columns pushed down into the read
+    :return: list with the columns of every key, None for keys in fixed format, which can only be read in full
+    """
+    columns = []
+    for i, key in enumerate(keys):
+        storer = store.get_storer(key)
+        if storer is None:
+            raise DataProcessorError("Key '{}' not found in HDF5 file".format(key))
+        if not storer.is_table:
+            columns.append(None)
+            continue
+        excluded = _excluded_columns(i, merge_on, exclude_cols_all, exclude_cols_except_first)
+        columns.append([col for col in storer.non_index_axes[0][1] if col not in excluded])
+    return columns
+
+
+def _check_columns(columns, seen, key, merge_on):
+    if merge_on not in columns:
+        raise DataProcessorError("Column '{}' not found in key '{}'".format(merge_on, key))
+    overlap = seen.intersection(columns) - {merge_on}
+    if overlap:
+        raise DataProcessorError("Columns {} of key '{}' are already present in a previous key, "
+                                 "add them to exclude_cols_except_first".format(sorted(overlap), key))
+    seen.update(columns)
+
+
+def _select_columns(store, key, use_cols, chunksize):
+    """
+    The columns use_cols of a key in table format. Data columns are read on their own with select_column;
+    the other columns are stored in blocks that PyTables reads row by row with all of their columns, so they are
+    read chunksize rows at a time and only the needed columns of every chunk are kept
+    """
+    storer = store.get_storer(key)
+    if set(use_cols) == set(storer.non_index_axes[0][1]) or storer.nrows == 0:
+        return store.select(key, columns=use_cols)
+    data_columns = set(storer.data_columns)
+    block_cols = [col for col in use_cols if col not in data_columns]
+    if block_cols:
+        # copied, a column selection can be a view that keeps all columns of the chunk alive
+        df = pd.concat([chunk[block_cols].copy()
+                        for chunk in store.select(key, columns=block_cols, chunksize=chunksize)])
+        df = df.reset_index(drop=True)
+    else:
+        df = pd.DataFrame(index=pd.RangeIndex(storer.nrows))
+    for col in use_cols:
+        if col in data_columns:
+            df[col] = store.select_column(key, col).to_numpy()
+    return df[use_cols]
+
+
+def _join_dataframes(store, keys, columns, merge_on, exclude_cols_all, exclude_cols_except_first, chunksize):
+    frames = []
+    seen = set()
+    for i, (key, use_cols) in enumerate(zip(keys, columns)):
+        if use_cols is None:
+            df = store.select(key)
+            excluded = _excluded_columns(i, merge_on, exclude_cols_all, exclude_cols_except_first)
+            df = df.drop([col for col in df.columns if col in excluded], axis=1)
+        else:
+            df = _select_columns(store, key, use_cols, chunksize)
+        _check_columns(df.columns, seen, key, merge_on)
+        if i == 0:
+            first_columns = list(df.columns)
+        frames.append(df.set_index(merge_on))
+        del df
+
+    # keep merge_on at its position in the first key, like DataFrame.merge does
+    merge_on_position = first_columns.index(merge_on)
+    base_df = frames[0].join(frames[1:], how='inner') if len(frames) > 1 else frames[0]
+    del frames
+
+    merge_on_values = base_df.index
+    base_df = base_df.reset_index(drop=True)
+    base_df.insert(merge_on_position, merge_on, merge_on_values)
+    return base_df
+
+
+def _read_column(store, key, column, chunksize):
+    try:
+        return store.select_column(key, column).to_numpy()
+    except KeyError:  # not a data column, read it from the values block in chunks
+        return np.concatenate([chunk[column].to_numpy()
+                               for chunk in store.select(key, columns=[column], chunksize=chunksize)])
+
+
+def _string_itemsizes(store, keys, columns, merge_on):
+    """
+    min_itemsize for the merged table: the widths of the string columns in the keys, for merge_on (a data column
+    of the output) and for the blocks of all other columns ('values')
+    """
+    itemsizes = {}
+    for key, use_cols in zip(keys, columns):
+        use_cols = set(use_cols)
+        for axis in store.get_storer(key).values_axes:
+            if axis.kind != 'string':
+                continue
+            for col in axis.values:
+                if col in use_cols:
+                    name = merge_on if col == merge_on else 'values'
+                    itemsizes[name] = max(itemsizes.get(name, 0), axis.itemsize)
+    return itemsizes
+
+
+def _merge_to_store(store, keys, columns, merge_on, chunksize, output_path, output_key, min_itemsize):
+    """
+    Inner join of the keys on merge_on, chunk by chunk: the merge_on column of every key is read first
+    to find the matching row coordinates, then only these rows are read from each key, one chunk at a time
+    """
+    seen = set()
+    for key, use_cols in zip(keys, columns):
+        if use_cols is None:
+            raise DataProcessorError("Key '{}' is not stored in table format, "
+                                     "it cannot be read in chunks".format(key))
+        _check_columns(use_cols, seen, key, merge_on)
+
+    first_values = _read_column(store, keys[0], merge_on, chunksize)
+    coordinates = [np.arange(len(first_values))]
+    matched = np.ones(len(first_values), dtype=bool)
+    for key in keys[1:]:
+        index = pd.Index(_read_column(store, key, merge_on, chunksize))
+        if not index.is_unique:
+            raise DataProcessorError("Column '{}' is not unique in key '{}'".format(merge_on, key))
+        indexer = index.get_indexer(first_values)
+        matched &= indexer >= 0
+        coordinates.append(indexer)
+    rows = np.flatnonzero(matched)
+    del first_values, matched
+
+    itemsizes = _string_itemsizes(store, keys, columns, merge_on)
+    for name, itemsize in (min_itemsize or {}).items():
+        itemsizes[name] = max(itemsizes.get(name, 0), itemsize)
+
+    with pd.HDFStore(output_path, mode='a') as output_store:
+        if output_key in output_store:
+            output_store.remove(output_key)
+        for start in range(0, len(rows), chunksize):
+            chunk_rows = rows[start:start + chunksize]
+            parts = []
+            for i, (key, use_cols) in enumerate(zip(keys, columns)):
+                if i > 0:
+                    use_cols = [col for col in use_cols if col != merge_on]
+                part = store.select(key, where=coordinates[i][chunk_rows], columns=use_cols)
+                part.index = pd.RangeIndex(start, start + len(chunk_rows))
+                parts.append(part)
+            output_store.append(output_key, pd.concat(parts, axis=1), format='table', data_columns=[merge_on],
+                                min_itemsize=itemsizes or None, index=False)
@@ -0,0 +1,115 @@
+import os
+import numpy as np
+import pandas as pd
+from .exceptions import DataProcessorError
+from .parallel import effective_n_jobs, get_executor
+from .transforms import TransformChain
+
+
+def make_folds(y, n_splits: int=5, shuffle: bool=True, random_state=None, stratify: bool=False):
+    """
+    Train/validation row indices of every fold, built once and shared by all folds and scorers
+    :param y: target values
+    :param n_splits:
+    :param shuffle:
+    :param random_state:
+    :param stratify: keep the class proportions in every fold
+    :return: list of (train_idx, valid_idx)
+    """
+    from sklearn.model_selection import KFold, StratifiedKFold
+
+    splitter = StratifiedKFold if stratify else KFold
+    splitter = splitter(n_splits=n_splits, shuffle=shuffle, random_state=random_state if shuffle else None)
+    return list(splitter.split(np.zeros(len(y)), y))
+
+
+def fit_predict(train, y_train, test, feature_columns, removers, transforms, predictor, predict_proba=False,
+                use_removers=True):
+    """
+    Fit fresh copies of the removers, transforms and predictor on the training rows only, and predict the test rows
+    :param train: dataframe with the training rows
+    :param y_train:
+    :param test: dataframe with the rows to predict
+    :param feature_columns: features the removers start from (or that are used directly, without removers)
+    :param removers: list of (remover class, parameters)
+    :param transforms: list of (transform class, parameters)
+    :param predictor: unfitted estimator, it is cloned
+    :param predict_proba: predict class probabilities; for two classes only the probability of the second one
+    :param use_removers:
+    :return: predictions, list of features used
+    """
+    from sklearn.base import clone
+
+    features = list(feature_columns)
+    if use_removers:
+        for remover_class, remover_params in removers:
+            remover = remover_class(**remover_params)
+            if hasattr(remover, 'n_jobs') and 'n_jobs' not in remover_params:
+                remover.n_jobs = 1  # the folds are already running in parallel
+            if hasattr(remover, 'verbose') and 'verbose' not in remover_params:
+                remover.verbose = False
+            if hasattr(remover, 'target'):  # the target column is not part of the training frame
+                features, _ = remover.fit(train, features, y=y_train)
+            else:
+                features, _ = remover.fit(train, features)
+
+    chain = TransformChain([transform_class(**transform_params) for transform_class, transform_params in transforms],
+                           verbose=False)
+    X_train = chain.fit_transform(chain.extract(train, features), features)
+    X_test = chain.transform(chain.extract(test, features))
+
+    predictor = clone(predictor)
+    predictor.fit(X_train, y_train)
+    if predict_proba:
+        predictions = predictor.predict_proba(X_test)
+        if predictions.shape[1] == 2:
+            predictions = predictions[:, 1]
+    else:
+        predictions = predictor.predict(X_test)
+    return predictions, features
+
+
+def _run_fold(X, columns, y, train_idx, valid_idx, spec):
+    if isinstance(X, str):
+        X = np.load(X, mmap_mode='r')  # the process workers map the file written by cross_validate
+    frame = pd.DataFrame(X, columns=columns, copy=False)
+    predictions, _ = fit_predict(frame.iloc[train_idx], y[train_idx], frame.iloc[valid_idx], columns,
+                                 spec['removers'], spec['transforms'], spec['predictor'], spec['predict_proba'],
+                                 spec['use_removers'])
+    # every scorer is evaluated on the same predictions
+    return [scorer(y[valid_idx], predictions) for scorer, _ in spec['scorers']]
+
+
+def cross_validate(X, columns, y, folds, spec, n_jobs=1, backend: str='thread', tmp_path=None):
+    """
+    Score every fold, concurrently if n_jobs > 1. With the process backend X is written to a .npy file
+    in tmp_path, which the workers memory-map instead of receiving a copy
+    :param X: 2D float array with all feature columns
+    :param columns: names of the columns of X
+    :param y:
+    :param folds: output of make_folds
+    :param spec: dict with removers, transforms, predictor, predict_proba, scorers and use_removers,
+    see fit_predict; with the process backend everything in it has to be picklable
+    :param n_jobs:
+    :param backend: 'thread' or 'process'
+    :param tmp_path: file for the memory-mapped data (process backend)
+    :return: array of scores, n_folds x n_scorers
+    """
+    if effective_n_jobs(n_jobs) == 1 or len(folds) == 1:
+        return np.array([_run_fold(X, columns, y, train_idx, valid_idx, spec) for train_idx, valid_idx in folds])
+
+    if backend == 'process':
+        if tmp_path is None:
+            raise DataProcessorError('A path for the memory-mapped data is needed with the process backend')
+        np.save(tmp_path, X)
+        data = tmp_path
+    else:
+        data = X
+    try:
+        with get_executor(n_jobs, backend) as executor:
+            futures = [executor.submit(_run_fold, data, columns, y, train_idx, valid_idx, spec)
+                       for train_idx, valid_idx in folds]
+            return np.array([future.result() for future in futures])
+    finally:
+        if backend == 'process':
+            os.remove(tmp_path)
@@ -1,8 +1,11 @@
 from os.path import isfile, isdir
+from pathlib import Path
 from shutil import rmtree
 from os import getcwd
+import json
 import unittest
-from src import dataprocessor, removers
+from src import dataprocessor, removers, transforms, cache, serving
+import numpy as np
 import pandas as pd
 
 
@@ -14,16 +17,20 @@ class DataProcessorTest(unittest.TestCase):
         self.dataprocessor = dataprocessor.DataProcessor(self.curr_dir, self.df, non_feature_columns=['nonfeat'])
 
     def tearDown(self):
-        rmtree(self.curr_dir + 'dataprocessor_files/')
+        rmtree(self.curr_dir + 'dataprocessor_files/', ignore_errors=True)
 
     def test_directory_creation(self):
+        # directories are created on the first write to them
+        self.assertEqual(isdir(self.curr_dir + 'dataprocessor_files'), False)
+        self.dataprocessor.save()
         self.assertEqual(isdir(self.curr_dir + 'dataprocessor_files/features/removed'), True)
         self.assertEqual(isdir(self.curr_dir + 'dataprocessor_files/features/selected'), True)
-
-        self.assertEqual(isdir(self.curr_dir + 'dataprocessor_files/output/cv'), True)
-        self.assertEqual(isdir(self.curr_dir + 'dataprocessor_files/output/predictions'), True)
-
         self.assertEqual(isdir(self.curr_dir + 'dataprocessor_files/settings'), True)
+        self.assertEqual(isdir(self.curr_dir + 'dataprocessor_files/output'), False)
+
+    def test_without_non_feature_columns(self):
+        dp = dataprocessor.DataProcessor(self.curr_dir, self.df)
+        self.assertListEqual(dp.features['all'], list(self.df.columns))
 
     def test_exclude_nonfeature_columns(self):
         self.assertNotIn('nonfeat', self.dataprocessor.features['all'])
@@ -41,6 +48,235 @@ class DataProcessorTest(unittest.TestCase):
         self.assertNotIn('const', selected)
         self.assertIn('const', removed)
 
+    def test_fit_stream(self):
+        rng = np.random.RandomState(0)
+        x = rng.normal(size=60)
+        df = pd.DataFrame({'x': x, 'x_p_1': 2 * x + 0.01 * rng.normal(size=60), 'big': np.exp(rng.uniform(0, 15, 60)),
+                           'y': rng.normal(size=60), 'const': np.where(np.arange(60) < 57, 1.0, 2.0),
+                           'nonfeat': ['a'] * 60})
+        df.loc[5, 'y'] = np.nan
+        batch = dataprocessor.DataProcessor(self.curr_dir, df, non_feature_columns=['nonfeat'], use_cache=False)
+        streamed = dataprocessor.DataProcessor(self.curr_dir, df, non_feature_columns=['nonfeat'], use_cache=False)
+        for dp in [batch, streamed]:
+            dp.add_remover(removers.AlmostConstantFeatureRemover, {'max_count_percent': 90})
+            dp.add_remover(removers.CorrelatedFeatureRemover, {'correlation_threshold': 0.9})
+            dp.add_transform(transforms.LogTransformer, {'threshold': 1e5})
+
+        selected, removed = batch.fit_remove(df)
+        expected = df.copy()
+        batch.fit_transform(expected)
+
+        self.assertListEqual(sorted(removed), ['const', 'x_p_1'])
+        streamed.fit_stream(lambda: (df.iloc[start:start + 25] for start in range(0, len(df), 25)))
+        self.assertListEqual(streamed.features['selected'], selected)
+        self.assertListEqual(sorted(streamed.features['removed']), sorted(removed))
+        self.assertListEqual(streamed.transforms[0].column_names_, ['big'])
+        chunks = (df.iloc[start:start + 25].copy() for start in range(0, len(df), 25))
+        pd.testing.assert_frame_equal(pd.concat(streamed.transform_stream(chunks)), expected)
+
+    def test_cv(self):
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.metrics import accuracy_score, f1_score
+        rng = np.random.RandomState(0)
+        x = rng.normal(size=80)
+        df = pd.DataFrame({'x': x, 'x_copy': x, 'noise': rng.normal(size=80), 'const': np.ones(80),
+                           'nonfeat': (x > 0).astype(int)})
+        dp = dataprocessor.DataProcessor(self.curr_dir, df, non_feature_columns=['nonfeat'], verbose=False)
+        dp.add_remover(removers.AlmostConstantFeatureRemover, {'max_count_percent': 90, 'verbose': False})
+        dp.add_remover(removers.CorrelatedFeatureRemover, {'correlation_threshold': 0.9, 'verbose': False})
+        dp.add_transform(transforms.LogTransformer, {})
+        scorers = [(accuracy_score, 'accuracy'), (f1_score, 'f1')]
+
+        mean_score, std_score = dp.cv(df, LogisticRegression(), scorers, target='nonfeat', random_state=0,
+                                      df_test=df.iloc[:5])
+        self.assertGreater(mean_score[0], 0.9)
+        self.assertEqual(len(std_score), 2)
+        self.assertTrue(isfile(self.curr_dir + 'dataprocessor_files/output/cv/cv.log'))
+        self.assertTrue(isfile(self.curr_dir + 'dataprocessor_files/output/predictions/' + dp.fname + '.csv'))
+
+        parallel_mean, _ = dp.cv(df, LogisticRegression(), scorers, target='nonfeat', random_state=0, n_jobs=2,
+                                 backend='process')
+        self.assertListEqual(parallel_mean, mean_score)
+
+        # a target that is not a non-feature column is still not used as a feature
+        df['label'] = rng.randint(0, 2, size=80)
+        dp = dataprocessor.DataProcessor(self.curr_dir, df.drop(columns='nonfeat'), verbose=False, use_cache=False)
+        dp.add_remover(removers.AlmostConstantFeatureRemover, {'max_count_percent': 90, 'verbose': False})
+        self.assertIn('label', dp.features['all'])
+        mean_score, std_score = dp.cv(df, LogisticRegression(), scorers, target='label', random_state=0,
+                                      df_test=df.iloc[:5])
+        self.assertLess(mean_score[0], 0.8)
+        self.assertGreater(std_score[0], 0)
+
+        # a remover that needs the target gets the target of the training rows of every fold
+        dp = dataprocessor.DataProcessor(self.curr_dir, df, non_feature_columns=['nonfeat'], verbose=False,
+                                         use_cache=False)
+        dp.add_remover(removers.PredictorBasedFeatureRemover, {'predictor': LogisticRegression(), 'target': 'nonfeat',
+                                                               'step': 1, 'verbose': False})
+        mean_score, _ = dp.cv(df, LogisticRegression(), scorers, target='nonfeat', random_state=0)
+        self.assertGreater(mean_score[0], 0.9)
+
+    def test_fit_cache(self):
+        self.dataprocessor.add_remover(removers.CorrelatedFeatureRemover, {'correlation_threshold': 0.5})
+        selected, removed = self.dataprocessor.fit_remove(self.df)
+        self.assertEqual(len(list(Path(self.curr_dir + 'dataprocessor_files/cache').glob('*.pkl'))), 1)
+
+        dp2 = dataprocessor.DataProcessor(self.curr_dir, self.df, non_feature_columns=['nonfeat'])
+        # keyed on the effective parameters, explicit defaults hit the same entry
+        dp2.add_remover(removers.CorrelatedFeatureRemover, {'correlation_threshold': 0.5, 'method': 'blockwise'})
+        remover = dp2.removers[0]
+        selected_dp2, removed_dp2 = dp2.fit_remove(self.df)
+        self.assertIsNot(remover, dp2.removers[0])  # replaced by the cached fitted remover
+        self.assertFalse(remover.fitted)
+        self.assertListEqual(selected, selected_dp2)
+        self.assertListEqual(removed, removed_dp2)
+        params = cache.effective_params(removers.CorrelatedFeatureRemover, {'correlation_threshold': 0.5})
+        self.assertEqual(params['strategy'], 'order')
+        self.assertNotIn('n_jobs', params)
+
+    def test_representative_score_persistence(self):
+        scores = [pd.Series(np.arange(1000.0), index=['f{}'.format(i) for i in range(1000)]) for _ in range(2)]
+        scores[1].iloc[500] = -1.0
+        keys = [cache.fingerprint(self.df, ['x'], 'CorrelatedFeatureRemover', cache.effective_params(
+            removers.CorrelatedFeatureRemover, {'representative_score': score})) for score in scores]
+        self.assertNotEqual(keys[0], keys[1])
+
+        # a callable score is neither cached nor saved with the fitted state
+        self.dataprocessor.add_remover(removers.CorrelatedFeatureRemover, {
+            'correlation_threshold': 0.5, 'strategy': 'cluster',
+            'representative_score': lambda df, columns: [-df[col].abs().mean() for col in columns]})
+        self.dataprocessor.fit_remove(self.df)
+        self.assertFalse(isdir(self.curr_dir + 'dataprocessor_files/cache'))
+        with self.assertWarns(UserWarning):
+            self.dataprocessor.save()
+        with self.assertRaises(dataprocessor.DataProcessorError):
+            dataprocessor.DataProcessor(self.curr_dir, self.df, non_feature_columns=['nonfeat'], restore=True)
+        dp2 = dataprocessor.DataProcessor(self.curr_dir, self.df, non_feature_columns=['nonfeat'])
+        self.assertListEqual(dp2.features['selected'], self.dataprocessor.features['selected'])
+
+    def test_restore_fitted_run(self):
+        self.dataprocessor.add_remover(removers.AlmostConstantFeatureRemover, {'max_count_percent': 80})
+        self.dataprocessor.add_transform(transforms.LogTransformer, {'threshold': 2})
+        self.dataprocessor.fit_remove(self.df)
+        expected = self.df.copy()
+        self.dataprocessor.fit_transform(expected)
+        self.dataprocessor.save()
+        first_run = self.dataprocessor.settings['run']
+        self.dataprocessor.save()  # saved within the same second, under a different name
+        self.assertNotEqual(first_run, self.dataprocessor.settings['run'])
+        self.assertEqual(len(list(Path(self.curr_dir + 'dataprocessor_files/runs/columns').glob('*.json'))), 1)
+        self.assertEqual(len(list(Path(self.curr_dir + 'dataprocessor_files/settings').glob('old_settings_*'))), 1)
+
+        dp2 = dataprocessor.DataProcessor(self.curr_dir, self.df, non_feature_columns=['nonfeat'], restore=True)
+        self.assertListEqual(dp2.features['selected'], self.dataprocessor.features['selected'])
+        self.assertListEqual(dp2.previous_remover_states, self.dataprocessor.remover_states)
+        self.assertListEqual(dp2.transforms[0].columns_, self.dataprocessor.transforms[0].columns_)
+        transformed = self.df.copy()
+        dp2.transform(transformed)
+        pd.testing.assert_frame_equal(transformed, expected)
+
+    def test_prediction_service(self):
+        from sklearn.linear_model import LinearRegression
+
+        rng = np.random.RandomState(0)
+        df = pd.DataFrame({'a': rng.uniform(0, 1e6, size=40), 'b': rng.normal(size=40), 'nonfeat': 'x'})
+        df['target'] = np.log1p(df['a']) + df['b']
+        dp = dataprocessor.DataProcessor(self.curr_dir, df, non_feature_columns=['nonfeat', 'target'])
+        dp.add_transform(transforms.LogTransformer, {'threshold': 100})
+        dp.features['selected'] = dp.features['all']
+        train = df.copy()
+        dp.fit_transform(train)
+        predictor = LinearRegression().fit(train[['a', 'b']].to_numpy(), train['target'])
+        dp.save()
+
+        service = serving.PredictionService(self.curr_dir, predictor, n_workers=2, queue_size=2, name='test')
+        with service:
+            predictions = service.client().predict_frame(df, batch_size=7)
+        np.testing.assert_allclose(predictions, predictor.predict(train[['a', 'b']].to_numpy()))
+        self.assertEqual(service.n_batches, 6)
+        written = pd.read_csv(self.curr_dir + 'dataprocessor_files/output/predictions/test.csv', index_col=0)
+        self.assertListEqual(sorted(written.index), list(range(40)))
+        np.testing.assert_allclose(service.predict(df.iloc[:3]), predictions[:3])
+        self.assertRaises(dataprocessor.DataProcessorError, service.predict, df[['a']])
+
+    def test_profiling(self):
+        records = []
+        dp = dataprocessor.DataProcessor(self.curr_dir, self.df, non_feature_columns=['nonfeat'], profile=True,
+                                         profile_hook=records.append, use_cache=False)
+        dp.add_remover(removers.CorrelatedFeatureRemover, {'correlation_threshold': 0.5})
+        dp.add_transform(transforms.LogTransformer, {'threshold': 2})
+        dp.fit_remove(self.df)
+        dp.fit_transform(self.df)
+        dp.save()
+        self.assertListEqual([(record['stage'], record['rows'], record['columns']) for record in records],
+                             [('fit', 3, 4), ('fit', 3, 3), ('transform', 3, 3), ('save', None, 4)])
+        self.assertTrue(all(record['wall_time'] >= 0 for record in records))
+
+        with open(self.curr_dir + 'dataprocessor_files/output/profile.jsonl', 'r') as f:
+            written = [json.loads(line) for line in f]
+        self.assertListEqual([record['component'] for record in written],
+                             [record['component'] for record in records])
+
+    def test_incremental_fit_remove(self):
+        rng = np.random.RandomState(0)
+        base = rng.normal(size=(50, 4))
+        df = pd.DataFrame(np.hstack([base, base[:, :2] + 0.01 * rng.normal(size=(50, 2))]),
+                          columns=['a', 'b', 'c', 'd', 'a2', 'b2'])
+        df['nonfeat'] = 'x'
+        params = [(removers.AlmostConstantFeatureRemover, {'max_count_percent': 80}),
+                  (removers.CorrelatedFeatureRemover, {'correlation_threshold': 0.9, 'block_size': 2})]
+
+        def processor(frame):
+            dp = dataprocessor.DataProcessor(self.curr_dir, frame, non_feature_columns=['nonfeat'], use_cache=False)
+            for remover, remover_params in params:
+                dp.add_remover(remover, remover_params)
+            return dp
+
+        dp = processor(df)
+        dp.fit_remove(df)
+        dp.save()
+
+        # add features correlated with old ones, a constant one, and drop 'a', the reason 'a2' was removed
+        df2 = df.drop('a', axis=1)
+        df2['c2'] = df['c'] * 3
+        df2['e'] = rng.normal(size=50)
+        df2['e2'] = df2['e'] + 0.01 * rng.normal(size=50)
+        df2['const'] = 1.0
+        incremental = processor(df2).fit_remove(df2, incremental=True)
+        full = processor(df2).fit_remove(df2)
+        self.assertListEqual(incremental[0], full[0])
+        self.assertListEqual(sorted(incremental[1]), sorted(full[1]))
+        self.assertListEqual(sorted(full[1]), ['b2', 'c2', 'const', 'e2'])
+
+    def test_write_features(self):
+        self.dataprocessor.add_remover(removers.AlmostConstantFeatureRemover, {'max_count_percent': 80})
+        selected, removed = self.dataprocessor.fit_remove(self.df)
+        for df_format in ['npy', 'feather']:
+            self.dataprocessor.write_features(self.df, df_format)
+            self.dataprocessor.save()
+
+            dp2 = dataprocessor.DataProcessor(self.curr_dir, self.df, non_feature_columns=['nonfeat'])
+            store = dp2.open_features()
+            self.assertListEqual(store.columns, selected + ['nonfeat'])
+            self.assertListEqual(list(store['x']), [-2, 0, 2])
+            if df_format == 'npy':
+                self.assertIsInstance(store['x'], np.memmap)
+            frame = store.to_frame(['x', 'nonfeat'])
+            self.assertListEqual(list(frame.columns), ['x', 'nonfeat'])
+            self.assertListEqual(list(frame['nonfeat']), ['a', 'b', 'c'])
+
+        dp3 = dataprocessor.DataProcessor(self.curr_dir, self.df, non_feature_columns=['nonfeat'])
+        dp3.add_remover(removers.CorrelatedFeatureRemover, {'correlation_threshold': 0.6})
+        dp3.fit_remove(self.df)
+        self.assertTrue(dp3.removers[0].fitted)  # different parameters, fitted from scratch
+
+    def test_cache_eviction(self):
+        result_cache = cache.ResultCache(self.curr_dir + 'dataprocessor_files/cache', max_size=2500)
+        for key in ['a', 'b', 'c']:
+            result_cache.put(key, b'x' * 1000)
+        self.assertIsNone(result_cache.get('a'))
+        self.assertEqual(result_cache.get('c'), b'x' * 1000)
+
 
 class DataProcessorPersistenceTest(unittest.TestCase):
     def setUp(self):
@@ -1,3 +1,5 @@
+import tempfile
+from shutil import rmtree
 import pandas as pd
 import numpy as np
 import unittest
@@ -14,6 +16,11 @@ class DataTransformsTest(unittest.TestCase):
                                  'txt': ['a', 'b', 'c', 'd', 'e']})
         self.df4 = pd.DataFrame({'x': [-2, 0, 2], 'x_p_1': [-100, 21, 3], 'x_t_x': [4, 0, 4]})
         self.df5 = pd.DataFrame({'x': [-2, 0, 2], 'x_p_2': [-100, 21, 3], 'x_t_x': [4, 0, 4]})
+        self.tmp_dir = tempfile.mkdtemp()
+        self.corr_file = self.tmp_dir + '/test.csv'
+
+    def tearDown(self):
+        rmtree(self.tmp_dir, ignore_errors=True)
 
     def test_log_scaling_pandas(self):
         df_copy = self.df.copy()
@@ -28,6 +35,48 @@ class DataTransformsTest(unittest.TestCase):
         self.assertEqual(scaled_df['z'][0], 0)
         self.assertEqual(scaled_df['y'][1], 9e4)
 
+    def test_log_scaling_inplace(self):
+        values = np.array(self.df.values, dtype=np.float32)
+        logtransform = transforms.LogTransformer(copy=False).fit(values)
+        scaled = logtransform.transform(values)
+        self.assertIs(scaled, values)
+        self.assertEqual(scaled.dtype, np.float32)
+        self.assertListEqual(logtransform.columns_, [0, 2])
+        self.assertEqual(scaled[1, 1], np.float32(9e4))
+        self.assertAlmostEqual(scaled[1, 0], np.log1p(1e7), places=4)
+
+        df_copy = self.df.copy()
+        logtransform.transform(df_copy)
+        self.assertLess(df_copy['x'].max(), 20)
+        self.assertEqual(df_copy['y'][1], 9e4)
+
+    def test_log_scaling_partial_fit(self):
+        df = pd.DataFrame({'x': [0, 5, 1e7, 3], 'y': [0, 9e4, 1, 2], 'z': [1e2, 1e-5, 3, 4]})
+        logtransform = transforms.LogTransformer().fit(df)
+        streamed = transforms.LogTransformer()
+        for start in range(0, len(df), 2):
+            streamed.partial_fit(df.iloc[start:start + 2])
+        self.assertListEqual(streamed.column_names_, logtransform.column_names_)
+        self.assertListEqual(streamed.min_vals_, logtransform.min_vals_)
+        pd.testing.assert_frame_equal(streamed.transform(df), logtransform.transform(df))
+
+    def test_transform_chain(self):
+        from sklearn.preprocessing import FunctionTransformer
+        chain = transforms.TransformChain([transforms.LogTransformer(), transforms.LogTransformer(threshold=20)],
+                                          verbose=False)
+        values = chain.extract(self.df, ['x', 'y', 'z'])
+        result = chain.fit_transform(values, ['x', 'y', 'z'])
+        self.assertIs(result, values)
+        self.assertListEqual(chain.copied_steps_, [])
+        self.assertListEqual(chain.transforms[0].column_names_, ['x', 'z'])
+        self.assertListEqual(chain.transforms[1].column_names_, ['y'])
+        self.assertAlmostEqual(values[1, 1], np.log1p(9e4))
+
+        chain = transforms.TransformChain([FunctionTransformer(np.sqrt)], verbose=False)
+        values = chain.fit_transform(chain.extract(self.df, ['x']), ['x'])
+        self.assertEqual(len(chain.copied_steps_), 1)
+        self.assertAlmostEqual(values[1, 0], np.sqrt(1e7))
+
     def test_find_correlated_features(self):
         corr_remover = removers.CorrelatedFeatureRemover(0.5)
         selected, correlated = corr_remover.fit(self.df2, ['x', 'x_p_1', 'x_t_x'])
@@ -48,9 +97,9 @@ class DataTransformsTest(unittest.TestCase):
         self.assertNotIn('txt', removed)
 
     def test_correlated_features_persistence(self):
-        corr_remover = removers.CorrelatedFeatureRemover(0.5, write_to_file='test.csv')
+        corr_remover = removers.CorrelatedFeatureRemover(0.5, write_to_file=self.corr_file)
         selected, correlated = corr_remover.fit(self.df2, ['x', 'x_p_1', 'x_t_x'])
-        corr_remover2 = removers.CorrelatedFeatureRemover(0.5, load_from_file='test.csv')
+        corr_remover2 = removers.CorrelatedFeatureRemover(0.5, load_from_file=self.corr_file)
 
         # the features are different, but since we read from file, it should remove based on the old dataframe
         selected, correlated = corr_remover2.fit(self.df4, ['x', 'x_p_1', 'x_t_x'])
@@ -59,9 +108,203 @@ class DataTransformsTest(unittest.TestCase):
         self.assertIn('x_p_1', correlated)  # we store the second feature in a separate field
 
     def test_correlated_features_persistence_error(self):
-        corr_remover = removers.CorrelatedFeatureRemover(0.5, write_to_file='test.csv')
+        corr_remover = removers.CorrelatedFeatureRemover(0.5, write_to_file=self.corr_file)
         selected, correlated = corr_remover.fit(self.df2, ['x', 'x_p_1', 'x_t_x'])
-        corr_remover2 = removers.CorrelatedFeatureRemover(0.5, load_from_file='test.csv')
+        corr_remover2 = removers.CorrelatedFeatureRemover(0.5, load_from_file=self.corr_file)
 
         self.assertRaises(exceptions.DataProcessorError,  corr_remover2.fit,
                           self.df5, ['x', 'x_p_2', 'x_t_x'])
+
+    def test_blockwise_correlation_matches_dense(self):
+        rng = np.random.RandomState(0)
+        base = rng.normal(size=(200, 6))
+        df = pd.DataFrame(np.hstack([base, base[:, :4] + 0.3 * rng.normal(size=(200, 4)), np.ones((200, 1))]),
+                          columns=['c{}'.format(i) for i in range(11)])
+        df.iloc[::7, 3] = np.nan
+        for frame in (df.fillna(0), df):
+            dense = removers.CorrelatedFeatureRemover(0.8, verbose=False, method='dense')
+            blockwise = removers.CorrelatedFeatureRemover(0.8, verbose=False, block_size=3)
+            selected_dense, removed_dense = dense.fit(frame, list(frame.columns))
+            selected_blockwise, removed_blockwise = blockwise.fit(frame, list(frame.columns))
+            self.assertListEqual(removed_dense, removed_blockwise)
+            self.assertListEqual(selected_dense, selected_blockwise)
+
+    def test_vectorized_almostconst_matches_per_column(self):
+        rng = np.random.RandomState(0)
+        df = pd.DataFrame({'normal': rng.normal(size=100), 'binary': rng.randint(0, 2, size=100),
+                           'mostly_zero': np.where(rng.uniform(size=100) < 0.95, 0, rng.normal(size=100)),
+                           'mostly_nan': np.where(rng.uniform(size=100) < 0.95, np.nan, 1.0),
+                           'flag': rng.uniform(size=100) < 0.97, 'txt': ['a'] * 96 + ['b'] * 4})
+        for max_count_percent in [50, 90, 94]:
+            vectorized = removers.AlmostConstantFeatureRemover(max_count_percent, verbose=False, chunk_size=2)
+            per_column = removers.AlmostConstantFeatureRemover(max_count_percent, verbose=False, method='per_column')
+            self.assertListEqual(vectorized.fit(df, df.columns)[1], per_column.fit(df, df.columns)[1])
+        self.assertListEqual(vectorized.columns_to_remove, ['mostly_zero', 'flag', 'txt'])
+
+    def test_parallel_removers(self):
+        rng = np.random.RandomState(0)
+        base = rng.normal(size=(100, 8))
+        values = np.hstack([base, base + 0.1 * rng.normal(size=(100, 8)), np.zeros((100, 4))])
+        df = pd.DataFrame(values, columns=['c{}'.format(i) for i in range(20)])
+        expected_correlated = removers.CorrelatedFeatureRemover(0.8, verbose=False).fit(df, df.columns)[1]
+        expected_constant = removers.AlmostConstantFeatureRemover(90, verbose=False).fit(df, df.columns)[1]
+        for backend in ['thread', 'process']:
+            corr_remover = removers.CorrelatedFeatureRemover(0.8, verbose=False, block_size=3, n_jobs=2,
+                                                             backend=backend)
+            const_remover = removers.AlmostConstantFeatureRemover(90, verbose=False, chunk_size=3, n_jobs=2,
+                                                                  backend=backend)
+            self.assertListEqual(corr_remover.fit(df, df.columns)[1], expected_correlated)
+            self.assertListEqual(const_remover.fit(df, df.columns)[1], expected_constant)
+
+    def test_streamed_almostconst_state(self):
+        rng = np.random.RandomState(0)
+        df = pd.DataFrame(rng.normal(size=(2000, 4)), columns=['a', 'b', 'c', 'd'])
+        df.loc[:1849, 'a'] = 1.0  # frequent values seen first, last, or split between two values
+        df.loc[150:, 'b'] = 2.0
+        df.loc[:1000, 'c'] = 3.0
+        df.loc[1001:, 'c'] = 4.0
+        expected = removers.AlmostConstantFeatureRemover(90, verbose=False).fit(df, df.columns)[1]
+        self.assertListEqual(expected, ['a', 'b'])
+        for percent in [90, 30]:
+            remover = removers.AlmostConstantFeatureRemover(percent, verbose=False)
+            for start in range(0, len(df), 100):
+                remover.partial_fit(df.iloc[start:start + 100], df.columns)
+                self.assertLessEqual(max(len(candidates) for candidates in remover._candidates),
+                                     remover.n_counters())
+            self.assertRaises(exceptions.DataProcessorError, remover.finalize)
+            for start in range(0, len(df), 100):
+                remover.partial_verify(df.iloc[start:start + 100])
+            self.assertListEqual(remover.finalize()[1], removers.AlmostConstantFeatureRemover(
+                percent, verbose=False).fit(df, df.columns)[1])
+
+    def test_sampled_correlation_screening(self):
+        rng = np.random.RandomState(0)
+        base = rng.normal(size=(5000, 10))
+        values = np.hstack([base, base[:, :5] + 0.2 * rng.normal(size=(5000, 5))])
+        df = pd.DataFrame(values, columns=['c{}'.format(i) for i in range(15)])
+        exact = removers.CorrelatedFeatureRemover(0.9, verbose=False).fit(df, df.columns)[1]
+        sampled_remover = removers.CorrelatedFeatureRemover(0.9, verbose=False, method='sampled', sample_size=500,
+                                                            random_state=0)
+        self.assertListEqual(sampled_remover.fit(df, df.columns)[1], exact)
+        self.assertEqual(len(exact), 5)
+        self.assertGreater(sampled_remover.n_pairs_pruned_, 90)
+        self.assertEqual(sampled_remover.n_pairs_pruned_ + sampled_remover.n_candidate_pairs_, 105)
+
+    def test_sparse_features(self):
+        from scipy import sparse
+
+        rng = np.random.RandomState(0)
+        counts = np.where(rng.uniform(size=(200, 6)) < 0.9, 0, rng.poisson(1e3, size=(200, 6))).astype(float)
+        onehot = (rng.randint(0, 2, size=200)[:, None] == [0, 1]).astype(float)  # perfectly anti-correlated
+        values = np.hstack([counts, 2 * counts[:, :2], onehot, np.full((200, 1), 3.0)])
+        dense = pd.DataFrame(values, columns=['c{}'.format(i) for i in range(values.shape[1])])
+        sparse_df = dense.astype(pd.SparseDtype(float, 0))
+        sparse_df['c10'] = sparse_df['c10'].astype(pd.SparseDtype(float, 3.0))
+        matrix = sparse.csr_matrix(values)
+        positions = list(range(values.shape[1]))
+
+        expected = removers.CorrelatedFeatureRemover(0.9, verbose=False).fit(dense, dense.columns)[1]
+        self.assertListEqual(expected, ['c6', 'c7', 'c9'])
+        self.assertListEqual(removers.CorrelatedFeatureRemover(0.9, verbose=False).fit(
+            sparse_df, sparse_df.columns)[1], expected)
+        self.assertListEqual(removers.CorrelatedFeatureRemover(0.9, verbose=False).fit(matrix, positions)[1],
+                             [dense.columns.get_loc(col) for col in expected])
+
+        expected = removers.AlmostConstantFeatureRemover(85, verbose=False).fit(dense, dense.columns)[1]
+        self.assertIn('c10', expected)
+        self.assertListEqual(removers.AlmostConstantFeatureRemover(85, verbose=False).fit(
+            sparse_df, sparse_df.columns)[1], expected)
+        self.assertListEqual(removers.AlmostConstantFeatureRemover(85, verbose=False).fit(matrix, positions)[1],
+                             [dense.columns.get_loc(col) for col in expected])
+        self.assertListEqual(removers.AlmostConstantFeatureRemover(85, verbose=False).fit(
+            matrix.tocoo(), positions)[1], [dense.columns.get_loc(col) for col in expected])
+
+        expected = transforms.LogTransformer(threshold=100).fit(dense).transform(dense)
+        transformed = transforms.LogTransformer(threshold=100).fit(sparse_df).transform(sparse_df)
+        self.assertTrue(all(isinstance(dtype, pd.SparseDtype) for dtype in transformed.dtypes))
+        np.testing.assert_allclose(transformed.sparse.to_dense().to_numpy(), expected.to_numpy())
+        transformed = transforms.LogTransformer(threshold=100).fit(matrix).transform(matrix)
+        self.assertTrue(sparse.issparse(transformed))
+        np.testing.assert_allclose(transformed.toarray(), expected.to_numpy())
+
+    def test_correlation_clusters(self):
+        rng = np.random.RandomState(0)
+        base = rng.normal(size=(1000, 3))
+        noise = 0.05 * rng.normal(size=(1000, 7))
+        df = pd.DataFrame({'a1': base[:, 0] + noise[:, 0], 'a2': 3 * base[:, 0] + noise[:, 1],
+                           'a3': 2 * base[:, 0] + noise[:, 2], 'b1': 0.5 * base[:, 1] + noise[:, 3],
+                           'b2': base[:, 1], 'b3': base[:, 1], 'c1': base[:, 2] + noise[:, 6]})
+        df.loc[:9, 'a2'] = np.nan
+
+        def fit(columns, **params):
+            remover = removers.CorrelatedFeatureRemover(0.9, verbose=False, strategy='cluster', **params)
+            return sorted(remover.fit(df, columns)[1])
+
+        shuffled = list(rng.permutation(df.columns))
+        # highest variance, ties (identical columns) broken by the name
+        self.assertListEqual(fit(df.columns), ['a1', 'a3', 'b1', 'b3'])
+        self.assertListEqual(fit(shuffled), ['a1', 'a3', 'b1', 'b3'])
+        self.assertListEqual(fit(shuffled, method='dense'), ['a1', 'a3', 'b1', 'b3'])
+        self.assertListEqual(fit(shuffled, representative_score='missing_rate'), ['a2', 'a3', 'b2', 'b3'])
+        self.assertListEqual(fit(shuffled, representative_score={'a1': 1.0, 'b3': 2.0}),
+                             ['a2', 'a3', 'b1', 'b2'])
+        self.assertListEqual(fit(shuffled, representative_score=lambda data, columns: -data[columns].mean().abs()),
+                             fit(shuffled, representative_score=dict(-df.mean().abs())))
+
+        streamed = removers.CorrelatedFeatureRemover(0.9, verbose=False, strategy='cluster')
+        for start in range(0, len(df), 300):
+            streamed.partial_fit(df.iloc[start:start + 300], shuffled)
+        self.assertListEqual(sorted(streamed.finalize()[1]), ['a1', 'a3', 'b1', 'b3'])
+
+        # the order strategy keeps the first column of every group
+        self.assertListEqual(removers.CorrelatedFeatureRemover(0.9, verbose=False).fit(df, df.columns)[1],
+                             ['a2', 'a3', 'b2', 'b3'])
+        with self.assertRaises(exceptions.DataProcessorError):
+            removers.CorrelatedFeatureRemover(0.9, strategy='graph')
+
+        from scipy import sparse
+        matrix = sparse.coo_matrix(df.fillna(0).to_numpy())
+        for score in ['variance', 'missing_rate']:
+            remover = removers.CorrelatedFeatureRemover(0.9, verbose=False, strategy='cluster',
+                                                        representative_score=score)
+            self.assertListEqual(remover.fit(matrix, list(range(7)))[1],
+                                 [0, 2, 3, 5] if score == 'variance' else [1, 2, 4, 5])
+
+    def test_predictor_based_elimination(self):
+        from sklearn.linear_model import LogisticRegression, Ridge
+
+        rng = np.random.RandomState(0)
+        values = rng.normal(size=(300, 20))
+        df = pd.DataFrame(values, columns=['f{}'.format(i) for i in range(20)])
+        df['y'] = 2 * values[:, 3] + values[:, 7] - values[:, 11] + 0.1 * rng.normal(size=300)
+        df['label'] = (df['y'] > 0).astype(int)
+        features = list(df.columns[:20])
+
+        remover = removers.PredictorBasedFeatureRemover(Ridge(), 'y', step=0.5, patience=10, tol=1e-3,
+                                                        random_state=0, verbose=False)
+        selected, removed = remover.fit(df, features)
+        self.assertListEqual(selected, ['f3', 'f7', 'f11'])
+        self.assertListEqual([h['n_features'] for h in remover.history_], [20, 10, 5, 3, 2, 1])
+        self.assertListEqual(removed, [col for col in features if col not in selected])
+
+        # three elimination steps per round, with the folds of all of them fitted together
+        remover = removers.PredictorBasedFeatureRemover(Ridge(), 'y', step=0.5, patience=10, tol=1e-3, n_candidates=3,
+                                                        n_jobs=4, backend='thread', random_state=0, verbose=False)
+        self.assertListEqual(remover.fit(df, features)[0], ['f3', 'f7', 'f11'])
+        self.assertListEqual([h['n_features'] for h in remover.history_], [20, 10, 5, 3, 2, 1])
+        for n_jobs in [1, 4]:
+            remover = removers.PredictorBasedFeatureRemover(LogisticRegression(), 'label', step=0.25, patience=10,
+                                                            n_candidates=3, n_jobs=n_jobs, backend='thread',
+                                                            random_state=0, verbose=False)
+            self.assertTrue({'f3', 'f7', 'f11'} <= set(remover.fit(df, features)[0]))
+            self.assertListEqual([h['n_features'] for h in remover.history_][:4], [20, 15, 12, 9])
+
+        # warm-started refits on a pool, stopping at the first round that does not improve the score
+        for backend in ['thread', 'process']:
+            remover = removers.PredictorBasedFeatureRemover(LogisticRegression(), 'label', step=0.25, patience=1,
+                                                            n_jobs=3, backend=backend, random_state=0, verbose=False)
+            selected, removed = remover.fit(df, features)
+            self.assertTrue({'f3', 'f7', 'f11'} <= set(selected))
+            self.assertListEqual([h['n_features'] for h in remover.history_], [20, 15, 12])
+            self.assertEqual(len(selected), 12)  # the smaller of the two subsets with the best score
+        self.assertRaises(exceptions.DataProcessorError, remover.fit, df.drop(columns='label'), features)
@@ -0,0 +1,71 @@
+from os import getcwd, remove
+import unittest
+import pandas as pd
+from src import utils
+from src import exceptions
+from src import profiling
+
+
+class LoadAndMergeTest(unittest.TestCase):
+    def setUp(self):
+        self.path = getcwd() + '/test_merge.h5'
+        self.out_path = getcwd() + '/test_merged.h5'
+        df1 = pd.DataFrame({'fname': ['a', 'b', 'c', 'd'], 'label': [0, 1, 0, 1], 'x': [1., 2., 3., 4.],
+                            'tmp': [0, 0, 0, 0]})
+        df2 = pd.DataFrame({'fname': ['d', 'b', 'a', 'e'], 'label': [1, 1, 0, 0], 'y': [40., 20., 10., 50.],
+                            'tmp': [1, 1, 1, 1]})
+        df3 = pd.DataFrame({'fname': ['a', 'b', 'd'], 'label': [0, 1, 1], 'z': [100., 200., 400.]})
+        df1.to_hdf(self.path, key='first', format='table')
+        df2.to_hdf(self.path, key='second', format='table', data_columns=['fname', 'y'])
+        df3.to_hdf(self.path, key='third')  # fixed format
+
+    def tearDown(self):
+        for path in [self.path, self.out_path]:
+            try:
+                remove(path)
+            except FileNotFoundError:
+                pass
+
+    def test_streaming_matches_merge(self):
+        kwargs = {'keys': ['first', 'second', 'third'], 'exclude_cols_all': ['tmp'],
+                  'exclude_cols_except_first': ['label', 'tmp']}
+        expected = utils.load_and_merge_dataframes(self.path, **kwargs)
+        streamed = utils.load_and_merge_dataframes(self.path, streaming=True, **kwargs)
+        pd.testing.assert_frame_equal(expected, streamed)
+        streamed = utils.load_and_merge_dataframes(self.path, streaming=True, chunksize=3, **kwargs)
+        pd.testing.assert_frame_equal(expected, streamed)
+
+    def test_merge_to_store(self):
+        kwargs = {'keys': ['first', 'second'], 'exclude_cols_all': ['tmp'],
+                  'exclude_cols_except_first': ['label', 'tmp']}
+        expected = utils.load_and_merge_dataframes(self.path, **kwargs)
+        result = utils.load_and_merge_dataframes(self.path, output_path=self.out_path, chunksize=2, **kwargs)
+        merged = pd.read_hdf(result, key='merged')
+        pd.testing.assert_frame_equal(expected, merged)
+
+        self.assertRaises(exceptions.DataProcessorError, utils.load_and_merge_dataframes, self.path,
+                          ['first', 'third'], output_path=self.out_path, exclude_cols_except_first=['label'])
+        self.assertRaises(exceptions.DataProcessorError, utils.load_and_merge_dataframes, self.path,
+                          ['first', 'second'], streaming=True)
+
+    def test_merge_to_store_string_widths(self):
+        df1 = pd.DataFrame({'fname': ['a', 'b', 'ccc', 'dddd'], 'label': ['x', 'y', 'zzzzz', 'x'], 'v': [1., 2., 3., 4.]})
+        df2 = pd.DataFrame({'fname': ['dddd', 'ccc', 'b', 'a'], 'w': [4., 3., 2., 1.]})
+        df1.to_hdf(self.path, key='long1', format='table')
+        df2.to_hdf(self.path, key='long2', format='table', data_columns=['fname'])
+        expected = utils.load_and_merge_dataframes(self.path, ['long1', 'long2'])
+        result = utils.load_and_merge_dataframes(self.path, ['long1', 'long2'], output_path=self.out_path,
+                                                 chunksize=2)
+        pd.testing.assert_frame_equal(expected, pd.read_hdf(result, key='merged'))
+
+    def test_profiled_merge(self):
+        records = []
+        profiler = profiling.Profiler(hook=records.append)
+        kwargs = {'keys': ['first', 'second'], 'exclude_cols_all': ['tmp'],
+                  'exclude_cols_except_first': ['label', 'tmp'], 'profiler': profiler}
+        merged = utils.load_and_merge_dataframes(self.path, **kwargs)
+        utils.load_and_merge_dataframes(self.path, output_path=self.out_path, chunksize=2, **kwargs)
+        self.assertEqual(len(records), 2)
+        for record in records:
+            self.assertEqual(record['stage'], 'load_and_merge_dataframes')
+            self.assertEqual((record['rows'], record['columns']), merged.shape)